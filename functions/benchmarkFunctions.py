@@ -0,0 +1,402 @@
+import os
+import sys
+import json
+import math
+import time
+import argparse
+import platform
+import tempfile
+import warnings
+import tracemalloc
+import numpy as np
+import pandas as pd
+import shapely
+from functions import houseFunctions as hfunc
+from functions import pollFunctions as pfunc
+from functions import demographicsFunctions as dfunc
+from functions import overlapFunctions as ofunc
+'''
+Benchmarks of the house, demographics, poll and overlap hot paths on synthetic data, fully offline:
+
+    python -m functions.benchmarkFunctions [benchmark ...] [--scales 1 3 10] [--save] [--tolerance 0.5]
+
+Generators write fake FEC house results, state district files, ACS S0201 files and generic ballot polls in the
+formats of Datasets/, and lay out district polygons on a grid. Scale 1 is about the size of the real data
+(435 races x 9 cycles); larger scales add districts per state first (the integer keys allow 99) and cycles after.
+Every benchmark is timed (best of a few runs) and memory profiled with tracemalloc at each scale, and the exponent
+of time ~ scale**exponent is fitted over the scales. Results are compared with a JSON baseline, a benchmark
+regresses when its time or peak memory grows past the tolerance or its exponent grows by more than
+exponent_tolerance.
+'''
+
+BASELINE_PATH = 'Datasets/benchmark_baseline.json'
+SCALES = (1, 3, 10)
+N_STATES = len(hfunc.state_abbrs)
+
+def scale_shape(scale, base_total, base_inner, max_inner):
+    '''Split a scaled size into an inner dimension (e.g. districts per state), grown first, and an outer one
+    (e.g. cycles).
+    arguments:
+        scale -- size relative to the real data (float)
+        base_total -- inner x outer at scale 1 (float)
+        base_inner -- inner dimension at scale 1 (float)
+        max_inner -- largest inner dimension (int)
+    returns:
+        inner dimension (int)
+        outer dimension (int)
+    '''
+    inner = int(min(max_inner, max(1, math.ceil(base_inner*scale))))
+    return inner, max(1, int(round(base_total*scale/inner)))
+
+def election_years(n_cycles, last=2018):
+    '''The n_cycles even years up to last.'''
+    if last - 2*(n_cycles - 1) < 2:
+        raise ValueError('{} cycles do not fit in 4 digit years'.format(n_cycles))
+    return list(range(last - 2*(n_cycles - 1), last + 1, 2))
+
+def fake_house_results(relFilePath, n_cycles, districts_per_state, n_candidates=3, seed=0):
+    '''Write house results in the format of Datasets/fec/1976-2016-house.csv.
+    arguments:
+        relFilePath -- path of the csv (str)
+        n_cycles -- number of elections, the even years up to 2018 (int)
+        districts_per_state -- districts of every state, at most 99 (int)
+        n_candidates -- candidates of every race: a democrat, a republican and others (int)
+        seed -- random seed (int)
+    returns:
+        number of rows (int)
+    '''
+    rng = np.random.default_rng(seed)
+    years = np.array(election_years(n_cycles))
+    n_races = len(years)*N_STATES*districts_per_state
+    race = np.repeat(np.arange(n_races), n_candidates)
+    state = (race//districts_per_state) % N_STATES
+    district = race % districts_per_state + 1
+    if districts_per_state == 1:
+        district[:] = 0 # at-large districts are numbered 0 in the FEC data
+    votes = rng.integers(1000, 300000, len(race))
+    party = np.array(['democrat', 'republican'] + ['independent']*max(0, n_candidates - 2))[:n_candidates]
+
+    df = pd.DataFrame({'year': years[race//(N_STATES*districts_per_state)],
+                       'state': hfunc.state_names[state], 'state_po': hfunc.state_abbrs[state],
+                       'state_fips': hfunc.state_fips[state], 'state_cen': 0, 'state_ic': 0, 'office': 'US House',
+                       'district': district, 'stage': 'gen', 'special': False,
+                       'candidate': np.char.add('Candidate ', (np.arange(len(race)) % 9973).astype(str)),
+                       'party': np.tile(party, n_races), 'writein': False, 'candidatevotes': votes,
+                       'totalvotes': np.repeat(votes.reshape(-1, n_candidates).sum(axis=1), n_candidates),
+                       'version': 20171005})
+    #the FEC file is not sorted
+    df.iloc[rng.permutation(len(df))].to_csv(relFilePath, index=False)
+    return len(df)
+
+#titles read by demographicsFunctions.read_cols_light(), the other rows of the real files are filler here
+DISTRICT_ROWS = [('People', 'Sex and Age', 'Total population'), ('People', 'Sex and Age', 'Male'),
+                 ('People', 'Sex and Age', 'Female')] + \
+                [('People', 'Race', title) for title in
+                 ['Total population', 'One race', 'White', 'Black or African American',
+                  'American Indian and Alaska Native', 'Asian', 'Native Hawaiian and Other Pacific Islander',
+                  'Some other race', 'Two or more races']] + \
+                [('People', 'Hispanic or Latino and Race', 'Hispanic or Latino (of any race)'),
+                 ('People', 'Hispanic or Latino and Race', 'Not Hispanic or Latino'),
+                 ('Education', 'Educational Attainment', 'Percent high school graduate or higher'),
+                 ('Education', 'Educational Attainment', "Percent bachelor's degree or higher"),
+                 ('Socioeconomic', 'Income and Benefits', 'Median household income (dollars)'),
+                 ('Socioeconomic', 'Income and Benefits', 'Mean household income (dollars)'),
+                 ('Workers', 'Employment Status', 'Unemployment Rate')]
+
+def fake_district_file(relFilePath, n_districts, n_rows=318, seed=0):
+    '''Write a state district file in the format of Datasets/California_District_all.csv.
+    arguments:
+        relFilePath -- path of the csv (str)
+        n_districts -- number of 'District NN Estimate' and 'District NN MOE' column pairs (int)
+        n_rows -- number of rows, filler rows are added after the titles that are read (int)
+        seed -- random seed (int)
+    returns:
+        number of values (int)
+    '''
+    rng = np.random.default_rng(seed)
+    rows = DISTRICT_ROWS + [('Housing', 'Filler', 'Filler {}'.format(i)) for i in range(n_rows - len(DISTRICT_ROWS))]
+    values = rng.integers(0, 800000, (len(rows), n_districts))
+    columns = {}
+    for i in range(n_districts):
+        columns['District {:02d} Estimate'.format(i + 1)] = values[:, i]
+        columns['District {:02d} MOE'.format(i + 1)] = '(+/- 5000 )'
+    df = pd.concat([pd.DataFrame(rows, columns=['Topic', 'Subject', 'Title']), pd.DataFrame(columns)], axis=1)
+    df.to_csv(relFilePath, index=False)
+    return values.size
+
+def fake_acs_files(relDir, n_files, districts_per_state, n_estimates=307, seed=0):
+    '''Write ACS S0201 files in the format of Datasets/demographics/ACS_YY_1YR_S0201_with_ann.csv, with the
+    columns of demographicsFunctions.acs_columns() among filler estimates.
+    arguments:
+        relDir -- folder of the files (str)
+        n_files -- number of files, surveys of 2010, 2012, 2014, 2016, 2017, ... (int)
+        districts_per_state -- districts of every state, at most 99 (int)
+        n_estimates -- estimate columns of every file, each followed by its margin of error (int)
+        seed -- random seed (int)
+    returns:
+        paths of the files (list of str)
+    '''
+    rng = np.random.default_rng(seed)
+    years = ([2010, 2012, 2014, 2016] + list(range(2017, 2100)))[:n_files]
+    state = np.repeat(np.arange(N_STATES), districts_per_state)
+    id2 = hfunc.state_fips[state]*100 + np.tile(np.arange(1, districts_per_state + 1), N_STATES)
+    paths = []
+    for year in years:
+        estimates = list(dfunc.acs_columns(year))
+        estimates += ['Estimate; FILLER - Item {}'.format(i) for i in range(n_estimates - len(estimates))]
+        codes = ['GEO.id', 'GEO.id2', 'GEO.display-label', 'POPGROUP.id', 'POPGROUP.display-label']
+        names = ['Id', 'Id2', 'Geography', 'Id', 'Population Group']
+        for i, estimate in enumerate(estimates):
+            codes += ['EST_VC{:02d}'.format(i), 'MOE_VC{:02d}'.format(i)]
+            names += [estimate, estimate.replace('Estimate;', 'Margin of Error;', 1)]
+        values = rng.uniform(0, 100, (len(id2), len(estimates))).round(1).astype(str)
+        values[rng.random(values.shape) < 0.01] = '(X)'
+        body = np.empty((len(id2), len(names)), dtype=object)
+        body[:, 0] = np.char.add('5001400US', np.char.zfill(id2.astype(str), 4))
+        body[:, 1] = np.char.zfill(id2.astype(str), 4)
+        body[:, 2] = 'Congressional District'
+        body[:, 3] = '001'
+        body[:, 4] = 'Total population'
+        body[:, 5::2] = values
+        body[:, 6::2] = '0.1'
+        relFilePath = os.path.join(relDir, 'ACS_{:02d}_1YR_S0201_with_ann.csv'.format(year % 100))
+        pd.DataFrame([names] + body.tolist(), columns=codes).to_csv(relFilePath, index=False)
+        paths.append(relFilePath)
+    return paths
+
+def fake_polls(relDir, years, polls_per_year, seed=0):
+    '''Write generic ballot polls in the format of Datasets/YYYY_generic_congressional_vote.csv.
+    arguments:
+        relDir -- folder of the files (str)
+        years -- election years, from 1678 on (list of ints)
+        polls_per_year -- polls of every year, ending up to 300 days before election day (int)
+        seed -- random seed (int)
+    '''
+    rng = np.random.default_rng(seed)
+    for year in years:
+        #polls get denser towards election day
+        days_before = np.minimum(rng.exponential(60, polls_per_year), 300).astype(int)
+        end = pd.Timestamp(pfunc.get_election_day(year)) - pd.to_timedelta(days_before, unit='D')
+        start = end - pd.to_timedelta(rng.integers(0, 5, polls_per_year), unit='D')
+        dem = rng.uniform(35, 55, polls_per_year).round()
+        rep = rng.uniform(35, 55, polls_per_year).round()
+        df = pd.DataFrame({'Poll': np.char.add('Poll ', np.arange(polls_per_year).astype(str)),
+                           'Date': start.strftime('%-m/%-d') + ' - ' + end.strftime('%-m/%-d'),
+                           'Sample': np.char.add(rng.integers(500, 3000, polls_per_year).astype(str), ' LV'),
+                           'Democrats (D)': dem, 'Republicans (R)': rep, 'Spread': dem - rep})
+        summary = pd.DataFrame({'Poll': ['RCP Average'], 'Date': ['10/1 - 11/1'], 'Sample': ['--'],
+                                'Democrats (D)': [dem.mean()], 'Republicans (R)': [rep.mean()], 'Spread': [0]})
+        pd.concat([summary, df]).to_csv(os.path.join(relDir, '{}_generic_congressional_vote.csv'.format(year)),
+                                        index=False)
+
+def fake_districts(years, grid, jitter=0.2, seed=0):
+    '''District polygons of every state on a grid: a state is a unit square, its districts are grid x grid cells
+    whose inner borders move by up to jitter of a cell every election.
+    arguments:
+        years -- election years (list of ints)
+        grid -- cells per side, at most 9 so districts fit in 2 digits (int)
+        jitter -- largest move of a border, as a fraction of a cell (float)
+        seed -- random seed (int)
+    returns:
+        dataframe indexed ST_DD_YYYY with the columns 'state', 'year' and 'shape', as overlapFunctions takes
+        it (pandas.dataframe)
+    '''
+    rng = np.random.default_rng(seed)
+    rows = []
+    for year in years:
+        for s, state in enumerate(hfunc.state_abbrs):
+            cuts = np.arange(grid + 1)/grid
+            x = cuts.copy()
+            y = cuts.copy()
+            x[1:-1] += rng.uniform(-jitter, jitter, grid - 1)/grid
+            y[1:-1] += rng.uniform(-jitter, jitter, grid - 1)/grid
+            x0, x1 = np.repeat(x[:-1], grid), np.repeat(x[1:], grid)
+            y0, y1 = np.tile(y[:-1], grid), np.tile(y[1:], grid)
+            shapes = shapely.box(2*s + x0, y0, 2*s + x1, y1)
+            for d, shape in enumerate(shapes):
+                rows.append(('{}_{:02d}_{}'.format(state, d + 1, year), state, year, shape))
+    df = pd.DataFrame(rows, columns=['index', 'state', 'year', 'shape']).set_index('index')
+    df.index.name = None
+    return df
+
+def setup_house(scale, relDir):
+    districts_per_state, n_cycles = scale_shape(scale, 435*9/N_STATES, 435./N_STATES, 99)
+    relFilePath = os.path.join(relDir, 'house.csv')
+    fake_house_results(relFilePath, n_cycles, districts_per_state)
+    return relFilePath, election_years(n_cycles)
+
+def bench_load_data(scale, relDir):
+    relFilePath, years = setup_house(scale, relDir)
+    return lambda: hfunc.load_data(relFilePath, minYear=years[0])
+
+def bench_clean_index(scale, relDir):
+    relFilePath, years = setup_house(scale, relDir)
+    winners, _ = hfunc.load_data(relFilePath, minYear=years[0])
+    return lambda: hfunc.clean_index(winners)
+
+def bench_fetch_trimmed_data(scale, relDir):
+    relFilePath, years = setup_house(scale, relDir)
+    winners, winners2 = hfunc.load_data(relFilePath, minYear=years[0])
+    winners, winners2 = hfunc.clean_index(winners), hfunc.clean_index(winners2)
+    poll = pd.Series(np.linspace(-5, 5, len(years)), index=years, name='national_poll')
+    return lambda: hfunc.fetch_trimmed_data(winners, winners2, minYear=years[min(1, len(years) - 1)], poll=poll)
+
+def bench_read_cols_light(scale, relDir):
+    relFilePath = os.path.join(relDir, 'district.csv')
+    fake_district_file(relFilePath, int(math.ceil(53*scale)))
+    return lambda: dfunc.read_cols_light(relFilePath, 'CA', 2016)
+
+def bench_acs_features(scale, relDir):
+    districts_per_state, n_files = scale_shape(scale, 435*5/N_STATES, 435./N_STATES, 99)
+    paths = fake_acs_files(relDir, min(n_files, 87), districts_per_state)
+    return lambda: dfunc.acs_features(paths, n_jobs=1)
+
+def bench_poll_table(scale, relDir):
+    polls_per_year, n_cycles = scale_shape(scale, 60*9, 60, 10000)
+    years = election_years(min(n_cycles, 170))
+    fake_polls(relDir, years, polls_per_year)
+    return lambda: pfunc.poll_table(pfunc.load_polls(years, relDir), windows=[None, 7, 14, 28, 60, 90])
+
+def bench_build_overlap(scale, relDir):
+    cells, n_cycles = scale_shape(scale, 435*9/N_STATES, 435./N_STATES, 81)
+    grid = int(math.ceil(math.sqrt(cells)))
+    years = election_years(max(2, int(round(n_cycles*cells/grid**2))))
+    district_df = fake_districts(years, grid)
+    return lambda: ofunc.build_overlap(district_df, years[1:], n_jobs=1)
+
+#name -- function(scale, relDir) writing the inputs of a scale to relDir, returns the call to measure
+BENCHMARKS = {'load_data': bench_load_data, 'clean_index': bench_clean_index,
+              'fetch_trimmed_data': bench_fetch_trimmed_data, 'read_cols_light': bench_read_cols_light,
+              'acs_features': bench_acs_features, 'poll_table': bench_poll_table,
+              'build_overlap': bench_build_overlap}
+
+def measure(func, repeat=3):
+    '''Best wall time of a few calls, and the peak memory allocated by one more call.
+    arguments:
+        func -- call to measure (function)
+        repeat -- number of timed calls (int)
+    returns:
+        seconds (float)
+        peak of the memory traced by tracemalloc during the call, in MB (float)
+    '''
+    seconds = []
+    #keep the output to the measurements, e.g. no mixed type warnings for the ACS columns holding '(X)'
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        for _ in range(repeat):
+            tic = time.perf_counter()
+            func()
+            seconds.append(time.perf_counter() - tic)
+        tracemalloc.start()
+        try:
+            func()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return min(seconds), peak/2.**20
+
+def scaling_exponent(scales, seconds):
+    '''Exponent of a power law time ~ scale**exponent, fitted in log-log space.
+    arguments:
+        scales -- scales (list of floats)
+        seconds -- time at each scale (list of floats)
+    returns:
+        exponent, nan with fewer than 2 scales (float)
+    '''
+    if len(scales) < 2:
+        return float('nan')
+    return float(np.polyfit(np.log(scales), np.log(np.maximum(seconds, 1e-6)), 1)[0])
+
+def run_benchmarks(names=None, scales=SCALES, repeat=3, verbose=True):
+    '''Run benchmarks at several scales.
+    arguments:
+        names -- benchmarks to run, None runs all of BENCHMARKS (list of str)
+        scales -- sizes relative to the real data (list of floats)
+        repeat -- see measure() (int)
+        verbose -- print every measurement (bool)
+    returns:
+        results keyed by benchmark name, each with the 'scales', 'seconds' and 'peak_mb' at every scale and the
+        fitted 'exponent' (dict)
+    '''
+    results = {}
+    for name in (BENCHMARKS if names is None else names):
+        result = {'scales': list(scales), 'seconds': [], 'peak_mb': []}
+        for scale in scales:
+            with tempfile.TemporaryDirectory() as relDir:
+                seconds, peak = measure(BENCHMARKS[name](scale, relDir), repeat)
+            result['seconds'].append(seconds)
+            result['peak_mb'].append(peak)
+            if verbose:
+                print('{:<20} x{:<6g} {:9.4f}s {:9.1f}MB'.format(name, scale, seconds, peak))
+        result['exponent'] = scaling_exponent(scales, result['seconds'])
+        if verbose:
+            print('{:<20} exponent {:.2f}'.format(name, result['exponent']))
+        results[name] = result
+    return results
+
+def save_baseline(results, relFilePath=BASELINE_PATH):
+    '''Write benchmark results as the baseline, together with the versions they were measured with.
+    arguments:
+        results -- output of run_benchmarks() (dict)
+        relFilePath -- path of the json baseline (str)
+    '''
+    baseline = {'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__,
+                'machine': platform.machine(), 'benchmarks': results}
+    with open(relFilePath, 'w') as f:
+        json.dump(baseline, f, indent=1)
+
+def compare_baseline(results, relFilePath=BASELINE_PATH, tolerance=0.5, exponent_tolerance=0.25, min_seconds=0.005):
+    '''Regressions of benchmark results against the baseline, for the benchmarks and scales found in both.
+    arguments:
+        results -- output of run_benchmarks() (dict)
+        relFilePath -- path of the json baseline (str)
+        tolerance -- relative growth of time or peak memory allowed (float)
+        exponent_tolerance -- growth of the scaling exponent allowed (float)
+        min_seconds -- times below this are too noisy to compare, as are exponents fitted on them (float)
+    returns:
+        one message per regression (list of str)
+    '''
+    with open(relFilePath) as f:
+        baseline = json.load(f)['benchmarks']
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        base = baseline[name]
+        for scale, seconds, peak in zip(result['scales'], result['seconds'], result['peak_mb']):
+            if scale not in base['scales']:
+                continue
+            i = base['scales'].index(scale)
+            if seconds > max(base['seconds'][i], min_seconds)*(1 + tolerance):
+                regressions.append('{} x{:g}: {:.4f}s, baseline {:.4f}s'.format(name, scale, seconds,
+                                                                                base['seconds'][i]))
+            if peak > base['peak_mb'][i]*(1 + tolerance) + 1.:
+                regressions.append('{} x{:g}: {:.1f}MB, baseline {:.1f}MB'.format(name, scale, peak,
+                                                                                  base['peak_mb'][i]))
+        if base['scales'] == result['scales'] and min(base['seconds']) >= min_seconds and \
+                result['exponent'] > base['exponent'] + exponent_tolerance:
+            regressions.append('{}: exponent {:.2f}, baseline {:.2f}'.format(name, result['exponent'],
+                                                                              base['exponent']))
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the hot paths on synthetic data.')
+    parser.add_argument('names', nargs='*', help='benchmarks to run, all by default: ' + ', '.join(BENCHMARKS))
+    parser.add_argument('--scales', nargs='+', type=float, default=list(SCALES),
+                        help='sizes relative to the real data')
+    parser.add_argument('--repeat', type=int, default=3, help='timed calls per measurement')
+    parser.add_argument('--baseline', default=BASELINE_PATH, help='path of the json baseline')
+    parser.add_argument('--save', action='store_true', help='write the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.5, help='relative growth of time and memory allowed')
+    parser.add_argument('--exponent-tolerance', type=float, default=0.25, help='growth of the exponent allowed')
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.names or None, [scale if scale % 1 else int(scale) for scale in args.scales],
+                             args.repeat)
+    if args.save:
+        save_baseline(results, args.baseline)
+    elif os.path.exists(args.baseline):
+        regressions = compare_baseline(results, args.baseline, args.tolerance, args.exponent_tolerance)
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,200 @@
+import numpy as np
+import pandas as pd
+import scipy.sparse as sparse
+from collections import namedtuple
+from functions import houseFunctions as hfunc
+from functions import overlapFunctions as ofunc
+'''
+Sparse crosswalks between the districts of consecutive elections.
+
+A crosswalk is the overlap dictionaries of one year pair as a scipy.sparse matrix: one row per district features
+are carried to, one column per district they come from, rows adding up to 1. The population overlap of a year
+maps this year's districts (rows) to the previous election's (columns), the inverse population overlap maps the
+previous election's districts back to this year's. Carrying a whole block of features across a redistricting is
+then a single sparse product instead of a walk over {district: weight} dictionaries.
+
+Districts are labelled by the integer keys of houseFunctions.encode_key().
+'''
+
+Crosswalk = namedtuple('Crosswalk', ['matrix', 'keys', 'keys_from'])
+Crosswalk.__doc__ = '''Sparse crosswalk.
+    matrix -- weight of each source district in each target district, shape (len(keys), len(keys_from))
+              (scipy.sparse.csr_matrix)
+    keys -- integer keys of the target districts, one per row (numpy.array of int64)
+    keys_from -- integer keys of the source districts, one per column (numpy.array of int64)
+'''
+
+WEIGHTS = ('area', 'population', 'inverse_population')
+
+def as_keys(labels):
+    '''Integer keys of district labels that may be integer keys already or legacy ST_DD_YYYY strings.
+    arguments:
+        labels -- district labels (array-like)
+    returns:
+        integer keys (numpy.array of int64)
+    '''
+    labels = np.asarray(labels)
+    if labels.dtype.kind in 'iu':
+        return labels.astype(np.int64)
+    return hfunc.index_to_key(labels)
+
+def make_crosswalk(targets, sources, weights, keys=None, keys_from=None):
+    '''Build a crosswalk from (target, source, weight) triplets.
+    arguments:
+        targets -- district each weight goes to (array-like of keys or ST_DD_YYYY strings)
+        sources -- district each weight comes from (array-like of keys or ST_DD_YYYY strings)
+        weights -- weights, those of a target should add up to 1 (array-like of floats)
+        keys -- rows of the crosswalk, defaults to the sorted targets. Targets without weights get an empty row.
+        keys_from -- columns of the crosswalk, defaults to the sorted sources
+    returns:
+        crosswalk (Crosswalk)
+    '''
+    targets, sources = as_keys(targets), as_keys(sources)
+    keys = np.unique(targets) if keys is None else as_keys(keys)
+    keys_from = np.unique(sources) if keys_from is None else as_keys(keys_from)
+
+    rows = pd.Index(keys).get_indexer(targets)
+    cols = pd.Index(keys_from).get_indexer(sources)
+    if (rows < 0).any() or (cols < 0).any():
+        raise KeyError('crosswalk weights refer to districts missing from keys or keys_from')
+    matrix = sparse.csr_matrix((np.asarray(weights, dtype=float), (rows, cols)), shape=(len(keys), len(keys_from)))
+    return Crosswalk(matrix, keys, keys_from)
+
+def crosswalk_from_pairs(pairs, weight='population', keys=None, keys_from=None):
+    '''Crosswalk of one year pair straight from the overlap pairs, skipping the dictionaries.
+    Weights are the same as the dictionaries of overlapFunctions.build_overlap().
+    arguments:
+        pairs -- output of overlapFunctions.year_overlap() (pandas.dataframe)
+        weight -- 'area' (overlap_frac), 'population' (population_overlap) or
+                  'inverse_population' (inverse_population_overlap, rows are the previous election's districts)
+        keys -- rows of the crosswalk, see make_crosswalk()
+        keys_from -- columns of the crosswalk, see make_crosswalk()
+    returns:
+        crosswalk (Crosswalk)
+    '''
+    if weight == 'area':
+        targets, sources, weights = ofunc.area_weights(pairs)
+    elif weight in WEIGHTS:
+        targets, sources, weights = ofunc.population_weights(pairs, inverse=weight == 'inverse_population')
+    else:
+        raise ValueError('weight must be one of {}, got {!r}'.format(WEIGHTS, weight))
+    return make_crosswalk(targets, sources, weights, keys=keys, keys_from=keys_from)
+
+def crosswalks_from_frame(district_df, column='population_overlap', years=None):
+    '''Convert a column of overlap dictionaries (overlap_frac, population_overlap or inverse_population_overlap
+    of the pickles written by overlap_area.ipynb) to one crosswalk per year pair.
+    arguments:
+        district_df -- dataframe indexed ST_DD_YYYY with a 'year' column and the dictionary column (pandas.dataframe)
+        column -- column holding the {district: weight} dictionaries (str)
+        years -- election years to convert, None converts every year with dictionaries (list of ints)
+    returns:
+        crosswalks keyed by election year (dict of Crosswalk). The inverse population overlap of a year is stored
+        on the previous election's rows, its crosswalk is keyed by the later of the two years.
+    '''
+    shift = 2 if column == 'inverse_population_overlap' else 0
+    has_dict = district_df[column].map(lambda overlap: isinstance(overlap, dict) and len(overlap) > 0)
+    frame = district_df.loc[has_dict.values, ['year', column]]
+    frame_years = frame['year'].astype(int) + shift
+
+    crosswalks = {}
+    for year in sorted(frame_years.unique()) if years is None else years:
+        dicts = frame.loc[(frame_years == year).values, column]
+        targets = np.repeat(dicts.index.values, dicts.map(len).values)
+        sources = [source for overlap in dicts for source in overlap]
+        weights = [weight for overlap in dicts for weight in overlap.values()]
+        crosswalks[int(year)] = make_crosswalk(targets, sources, weights, keys=np.sort(as_keys(dicts.index)))
+    return crosswalks
+
+def stack_crosswalks(crosswalks):
+    '''Join several crosswalks into one block diagonal crosswalk, so every year pair is carried in one product.
+    arguments:
+        crosswalks -- crosswalks to join (iterable of Crosswalk, or dict of them)
+    returns:
+        crosswalk (Crosswalk)
+    '''
+    if isinstance(crosswalks, dict):
+        crosswalks = [crosswalks[year] for year in sorted(crosswalks)]
+    crosswalks = list(crosswalks)
+    matrix = sparse.block_diag([crosswalk.matrix for crosswalk in crosswalks], format='csr')
+    return Crosswalk(matrix, np.concatenate([crosswalk.keys for crosswalk in crosswalks]),
+                     np.concatenate([crosswalk.keys_from for crosswalk in crosswalks]))
+
+def carry(crosswalk, features, skipna=True, string_index=None):
+    '''Carry a block of numeric features across a crosswalk with one sparse product.
+    arguments:
+        crosswalk -- crosswalk to carry the features over (Crosswalk)
+        features -- features of the source districts, indexed by integer key or ST_DD_YYYY (pandas.dataframe).
+                    Sources missing from features count as missing values.
+        skipna -- weight only the sources with a value, rescaled to add up to 1. Otherwise any missing source
+                  makes the target missing. (bool)
+        string_index -- index the result ST_DD_YYYY, defaults to whatever features uses (bool)
+    returns:
+        features of the target districts, missing where no source had a value (pandas.dataframe)
+    '''
+    is_series = isinstance(features, pd.Series)
+    if is_series:
+        features = features.to_frame()
+    if string_index is None:
+        string_index = features.index.dtype.kind not in 'iu'
+    source = features.set_axis(as_keys(features.index), axis=0)
+    source = source[~source.index.duplicated(keep='first')].reindex(crosswalk.keys_from)
+    values = source.to_numpy(dtype=float)
+
+    if skipna:
+        present = ~np.isnan(values)
+        weight = crosswalk.matrix @ present.astype(float)
+        carried = crosswalk.matrix @ np.where(present, values, 0.)
+        carried = np.where(weight > 0, carried/np.where(weight > 0, weight, 1.), np.nan)
+    else:
+        #missing sources propagate through the product, targets without any source are missing too
+        carried = crosswalk.matrix @ values
+        carried[crosswalk.matrix.getnnz(axis=1) == 0] = np.nan
+
+    index = hfunc.key_to_index(crosswalk.keys) if string_index else pd.Index(crosswalk.keys, name='key')
+    carried = pd.DataFrame(carried, index=index, columns=features.columns)
+    return carried.iloc[:, 0] if is_series else carried
+
+def carry_frame(df, crosswalks, columns, skipna=True):
+    '''Carry columns of a dataset from every election to the next one (or back, with inverse crosswalks)
+    across all year pairs at once.
+    arguments:
+        df -- dataset indexed ST_DD_YYYY or by integer key, holding the source rows (pandas.dataframe)
+        crosswalks -- crosswalks of the year pairs to carry (dict or list of Crosswalk)
+        columns -- numeric columns to carry (list)
+        skipna -- see carry() (bool)
+    returns:
+        carried columns of every target district present in df (pandas.dataframe)
+    '''
+    carried = carry(stack_crosswalks(crosswalks), df[list(columns)], skipna=skipna)
+    return carried[carried.index.isin(df.index)]
+
+def save_crosswalks(crosswalks, relFilePath):
+    '''Save crosswalks keyed by year to a single compressed .npz file, no pickling.
+    arguments:
+        crosswalks -- crosswalks keyed by election year (dict of Crosswalk)
+        relFilePath -- path of the .npz file (str)
+    '''
+    arrays = {}
+    for year, crosswalk in crosswalks.items():
+        matrix = crosswalk.matrix.tocsr()
+        arrays.update({'{}_data'.format(year): matrix.data, '{}_indices'.format(year): matrix.indices,
+                       '{}_indptr'.format(year): matrix.indptr, '{}_keys'.format(year): crosswalk.keys,
+                       '{}_keys_from'.format(year): crosswalk.keys_from})
+    np.savez_compressed(relFilePath, **arrays)
+
+def load_crosswalks(relFilePath):
+    '''Load crosswalks saved by save_crosswalks().
+    arguments:
+        relFilePath -- path of the .npz file (str)
+    returns:
+        crosswalks keyed by election year (dict of Crosswalk)
+    '''
+    crosswalks = {}
+    with np.load(relFilePath, allow_pickle=False) as arrays:
+        years = sorted({int(name.split('_')[0]) for name in arrays.files})
+        for year in years:
+            keys, keys_from = arrays['{}_keys'.format(year)], arrays['{}_keys_from'.format(year)]
+            matrix = sparse.csr_matrix((arrays['{}_data'.format(year)], arrays['{}_indices'.format(year)],
+                                        arrays['{}_indptr'.format(year)]), shape=(len(keys), len(keys_from)))
+            crosswalks[year] = Crosswalk(matrix, keys, keys_from)
+    return crosswalks
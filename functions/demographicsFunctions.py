@@ -1,3 +1,10 @@
+import os
+import re
+import csv
+import pandas as pd
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from functions import houseFunctions as hfunc
 '''
 Read a subset of data from file
 
@@ -8,72 +15,294 @@ Read a subset of data from file
 @return:  dataframe with a subset of data
 '''
 def read_cols_light(relFilePath, state, year):
-    
-    #read from file
-    data_df = pd.read_csv(relFilePath)
-                              
-    
+
+    #MOE columns are dropped by selection before anything is parsed
+    header = pd.read_csv(relFilePath, nrows=0).columns
+    value_cols = [col for col in header if col not in ('Topic', 'Subject', 'Title') and 'MOE' not in col]
+
+    #read from file, once
+    data_df = pd.read_csv(relFilePath, usecols=['Topic', 'Subject', 'Title'] + value_cols)
+    list_cols = district_titles(data_df)
+
+    #pivot once: one row per district, one column per title
+    rows = data_df[data_df['Title'].isin(list_cols)].drop_duplicates('Title').set_index('Title')
+    df = rows.loc[list_cols, value_cols].transpose()
+    df.columns.name = None
+
+    #Add state and Year column
+    df['state']=state
+    df['year'] = year
+
+    #return the dataframe
+    return df
+
+def district_titles(data_df):
+    '''Titles (rows) of a state district file kept by read_cols_light().
+    arguments:
+        data_df -- the Topic, Subject and Title columns of a state district file (pandas.dataframe)
+    returns:
+        titles in output column order (list)
+    '''
+    people = data_df['Topic']=='People'
+
     #People Topic Gender and Age
-    people_sexage_data = data_df[(data_df['Topic']=='People') & (data_df['Subject']=="Sex and Age")]
-    people_sexage_data = people_sexage_data.set_index('Title').transpose()
     #people_cols = people_sexage_data.columns (if we want to add age)
     people_sexage_cols = ['Male','Female']
 
-    
     #People Race
-    people_race_data = data_df[(data_df['Topic']=='People') & (data_df['Subject']=="Race")]
-    people_race_data = people_race_data.set_index('Title').transpose()
-    people_race_cols = people_race_data.columns.difference(['Total population']).tolist()
+    people_race_data = data_df.loc[people & (data_df['Subject']=="Race"), 'Title']
+    people_race_cols = pd.Index(people_race_data).difference(['Total population']).tolist()
 
-        
     #People Hipanic or Latino
-    people_hispanics_data = data_df[(data_df['Topic']=='People') & (data_df['Subject']=="Hispanic or Latino and Race")]
-    people_hispanics_data = people_hispanics_data.set_index('Title').transpose()
-    #people_hispanics_cols = people_hispanics_data.columns.difference(['Total population']).tolist()
     people_hispanics_cols = ['Hispanic or Latino (of any race)','Not Hispanic or Latino']
 
-        
-
     #Education Topic
-    education_data = data_df[(data_df['Topic']=='Education') & (data_df['Subject']=="Educational Attainment")]
-    education_data = education_data.set_index('Title').transpose()
-    #education_cols = education_data.columns.difference(['Total population']).tolist()
     education_cols = ["Percent high school graduate or higher","Percent bachelor's degree or higher"]
 
     #Socioeconomic Topic
-    socioeconomic_data = data_df[(data_df['Topic']=='Socioeconomic') & (data_df['Subject']=="Income and Benefits (In 2017 inflation-adjusted dollars)")]
-    socioeconomic_data = socioeconomic_data.set_index('Title').transpose()
-    #socioeconomic_cols = socioeconomic_data.columns.difference(['Total population']).tolist()
     socioeconomic_cols = ["Median household income (dollars)","Mean household income (dollars)"]
 
-    
     #Workers Topic
-    workers_data = data_df[(data_df['Topic']=='workers_data') & (data_df['Subject']=="Employment Status")]
-    workers_data = workers_data.set_index('Title').transpose()
-    #workers_cols = workers_data.columns.difference(['Total population']).tolist()
     workers_cols = ["Unemployment Rate"]
 
-    
-    #COLUMNS TO READ
-    list_cols = people_sexage_cols + people_race_cols+\
-                people_hispanics_cols+education_cols +\
-                socioeconomic_cols + workers_cols
-    
-                          
-    #create the dataFrame
-    df = pd.DataFrame()
-    for col in list_cols:
-        df[col]=data_df.set_index('Title').transpose()[col]
-    
-    #Add state and Year column
-    df['state']=state
-    df['year'] = year
-    
-    #Remove the first 2 entries and MOE
-    df=df.transpose()
-    df=df.drop(['Topic','Subject'],axis=1)
-    df = df[df.columns.drop(list(df.filter(regex='MOE')))]
-    df=df.transpose()
-    
-    #return the dataframe
-    return df  
+    return people_sexage_cols + people_race_cols+\
+           people_hispanics_cols+education_cols +\
+           socioeconomic_cols + workers_cols
+
+def read_district_long(relFilePath, state, year):
+    '''Read a state district file into long format.
+    arguments:
+        relFilePath -- file path of district data (str)
+        state -- state abbreviation (str)
+        year -- year (int)
+    returns:
+        dataframe with the columns state, district, year, variable and value (pandas.dataframe)
+    '''
+    df = read_cols_light(relFilePath, state, int(year)).drop(['state', 'year'], axis=1)
+    #'District 01 Estimate' -> 1, districts start with 1
+    district = df.index.str.extract(r'(\d+)', expand=False).fillna('1').astype(int)
+    df.insert(0, 'district', np.where(district == 0, 1, district))
+    long_df = df.melt(id_vars='district', var_name='variable', value_name='value')
+    long_df.insert(0, 'state', state)
+    long_df.insert(2, 'year', int(year))
+    return long_df
+
+def acs_header(relFilePath):
+    '''Descriptive column names of an ACS S0201 file, i.e. its 2nd header row, with duplicate names numbered
+    the same way pandas.read_csv(header=1) numbers them ('name', 'name.1', ...).
+    arguments:
+        relFilePath -- file path of ACS data (str)
+    returns:
+        column names (list)
+    '''
+    with open(relFilePath, newline='') as f:
+        reader = csv.reader(f)
+        next(reader)
+        names = next(reader)
+    seen = {}
+    mangled = []
+    for name in names:
+        count = seen.get(name, 0)
+        seen[name] = count + 1
+        mangled.append(name if count == 0 else '{}.{}'.format(name, count))
+    return mangled
+
+def read_acs_long(relFilePath, year=None, columns=None):
+    '''Read an ACS S0201 file (Datasets/demographics/ACS_YY_1YR_S0201_with_ann.csv) into long format.
+    Only the Id2 column and the requested estimate columns are parsed, margin of error columns are never read.
+    arguments:
+        relFilePath -- file path of ACS data (str)
+        year -- year of the survey, parsed from the file name if None (int)
+        columns -- 'Estimate; ...' columns to keep, None keeps every estimate (list)
+    returns:
+        dataframe with the columns state, district, year, variable and value (pandas.dataframe)
+    '''
+    if year is None:
+        year = 2000 + int(re.search(r'ACS_(\d{2})_', os.path.basename(relFilePath)).group(1))
+    names = acs_header(relFilePath)
+    wanted = [i for i, name in enumerate(names)
+              if name.startswith('Estimate;') and (columns is None or name in columns)]
+    id2 = names.index('Id2')
+
+    df = pd.read_csv(relFilePath, header=None, skiprows=2, usecols=[id2] + wanted)
+    df.columns = [names[i] for i in [id2] + wanted]
+
+    #Id2 is the state fips code followed by the 2 digit district, districts start with 1
+    fips_to_abbr = dict(zip(hfunc.state_fips, hfunc.state_abbrs))
+    district = (df['Id2'] % 100).values
+    keys = pd.DataFrame({'state': (df['Id2'] // 100).map(fips_to_abbr).values,
+                         'district': np.where(district == 0, 1, district),
+                         'year': year})
+    long_df = pd.concat([keys, df.drop('Id2', axis=1)], axis=1).melt(
+        id_vars=['state', 'district', 'year'], var_name='variable', value_name='value')
+    return long_df
+
+def load_demographics(acsFiles=(), districtFiles=(), columns=None, renames=None, numeric=False, n_jobs=None):
+    '''Batch loader for all demographics files. Every file is parsed once, files are spread over a process pool.
+    arguments:
+        acsFiles -- file paths of ACS S0201 data, the year is parsed from the file name (list)
+        districtFiles -- (relFilePath, state, year) of every state district file (list of tuples)
+        columns -- ACS 'Estimate; ...' columns to keep, None keeps every estimate (list)
+        renames -- map from raw variable names to common names, e.g. to line up the 2010-2012 and 2014+ ACS names (dict)
+        numeric -- convert values to floats, entries like '250,000+' become nan (bool)
+        n_jobs -- number of worker processes, 1 parses in this process, None uses every core (int)
+    returns:
+        long format dataframe with the columns state, district, year, key, variable and value,
+        key is the integer district key of houseFunctions.encode_key() (pandas.dataframe)
+    '''
+    tasks = [(read_acs_long, (relFilePath, None, columns)) for relFilePath in acsFiles] + \
+            [(read_district_long, tuple(task)) for task in districtFiles]
+    if n_jobs == 1 or len(tasks) <= 1:
+        frames = [func(*args) for func, args in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            futures = [pool.submit(func, *args) for func, args in tasks]
+            frames = [future.result() for future in futures]
+    if not frames:
+        return pd.DataFrame(columns=['state', 'district', 'year', 'key', 'variable', 'value'])
+
+    long_df = pd.concat(frames, ignore_index=True)
+    long_df.insert(3, 'key', hfunc.frame_key(long_df))
+    if renames:
+        long_df['variable'] = long_df['variable'].replace(renames)
+    long_df['variable'] = long_df['variable'].astype('category')
+    if numeric:
+        long_df['value'] = pd.to_numeric(long_df['value'].astype(str).str.replace(',', ''), errors='coerce')
+    return long_df.sort_values(['year', 'state', 'district'], kind='mergesort').reset_index(drop=True)
+
+def pivot_demographics(long_df):
+    '''One row per district and year, one column per variable, indexed like the other datasets (ST_DD_YYYY).
+    arguments:
+        long_df -- dataframe made by load_demographics() (pandas.dataframe)
+    returns:
+        wide dataframe (pandas.dataframe)
+    '''
+    long_df = long_df.drop_duplicates(['key', 'variable'], keep='first')
+    wide = long_df.pivot(index='key', columns='variable', values='value')
+    wide.columns = wide.columns.astype(str)
+    wide.columns.name = None
+    state, district, year = hfunc.decode_key(wide.index)
+    wide.insert(0, 'state', state)
+    wide.insert(1, 'district', district)
+    wide.insert(2, 'year', year)
+    wide.index = hfunc.key_to_index(wide.index)
+    return wide
+
+#ACS S0201 estimates behind the demographic features of ACS_Demographics_Processing.ipynb.
+#the 2014 and later files name them differently, {year} is the dollar year of the income estimates
+ACS_FEATURES = ['female_pct', 'age18_24_pct', 'age25_34_pct', 'median_age', 'unmarried_partner_pct',
+                'male_living_alone_pct', 'bachelors_deg_or_higher_pct', 'past_year_births_to_unmarried_women_pct',
+                'civilian_veteran_pct', 'live_same_house_past_year_pct', 'native_born_population',
+                'foreign_born_population', 'foreign_born_proportion_from_LatinAmerica',
+                'speak_other_language_at_home_pct', 'labor_force_unemployed_pct', 'public_transit_commuter_pct',
+                'no_health_insurance_pct', 'poverty_rate_pct', 'median_housing_value', 'median_household_income',
+                'food_stamp_benefits_pct']
+
+ACS_COLUMNS_10_12 = [
+    "Estimate; SEX AND AGE - Female",
+    "Estimate; SEX AND AGE - 18 to 24 years",
+    "Estimate; SEX AND AGE - 25 to 34 years",
+    "Estimate; SEX AND AGE - Median age (years)",
+    "Estimate; RELATIONSHIP - Nonrelatives - Unmarried partner",
+    "Estimate; HOUSEHOLDS BY TYPE - Nonfamily households - Male householder - Living alone",
+    "Estimate; EDUCATIONAL ATTAINMENT - Bachelor's degree or higher",
+    "Estimate; FERTILITY - Women 15 to 50 years who had a birth in the past 12 months - Unmarried women 15 to 50 "
+    "years who had a birth in the past 12 months - As a percent of all women with a birth in the past 12 months",
+    "Estimate; VETERAN STATUS - Civilian veteran",
+    "Estimate; RESIDENCE 1 YEAR AGO - Same house",
+    "Estimate; PLACE OF BIRTH, CITIZENSHIP STATUS AND YEAR OF ENTRY - Native",
+    "Estimate; PLACE OF BIRTH, CITIZENSHIP STATUS AND YEAR OF ENTRY - Foreign born",
+    "Estimate; WORLD REGION OF BIRTH OF FOREIGN BORN - Latin America",
+    "Estimate; LANGUAGE SPOKEN AT HOME AND ABILITY TO SPEAK ENGLISH - Language other than English",
+    "Estimate; EMPLOYMENT STATUS - In labor force - Civilian labor force - Unemployed",
+    "Estimate; COMMUTING TO WORK - Public transportation (excluding taxicab)",
+    "Estimate; HEALTH INSURANCE COVERAGE - No health insurance coverage",
+    "Estimate; POVERTY RATES FOR FAMILIES AND PEOPLE FOR WHOM POVERTY STATUS IS DETERMINED - All people",
+    "Estimate; OWNER CHARACTERISTICS - Median value (dollars)",
+    "Estimate; INCOME IN THE PAST 12 MONTHS (IN {year} INFLATION-ADJUSTED DOLLARS) - Median household income (dollars)",
+    "Estimate; INCOME IN THE PAST 12 MONTHS (IN {year} INFLATION-ADJUSTED DOLLARS) - With Food Stamp/SNAP benefits"]
+
+ACS_COLUMNS_14 = [
+    "Estimate; SEX AND AGE - Total population - Female",
+    "Estimate; SEX AND AGE - 18 to 24 years",
+    "Estimate; SEX AND AGE - 25 to 34 years",
+    "Estimate; SEX AND AGE - Median age (years)",
+    "Estimate; RELATIONSHIP - Population in households - Nonrelatives - Unmarried partner",
+    "Estimate; HOUSEHOLDS BY TYPE - Households - Nonfamily households - Male householder - Living alone",
+    "Estimate; EDUCATIONAL ATTAINMENT - Bachelor's degree or higher",
+    "Estimate; FERTILITY - Women 15 to 50 years - Women 15 to 50 years who had a birth in the past 12 months - "
+    "Unmarried women 15 to 50 years who had a birth in the past 12 months - As a percent of all women with a birth "
+    "in the past 12 months",
+    "Estimate; VETERAN STATUS - Civilian population 18 years and over - Civilian veteran",
+    "Estimate; RESIDENCE 1 YEAR AGO - Population 1 year and over - Same house",
+    "Estimate; PLACE OF BIRTH, CITIZENSHIP STATUS AND YEAR OF ENTRY - Native",
+    "Estimate; PLACE OF BIRTH, CITIZENSHIP STATUS AND YEAR OF ENTRY - Foreign born",
+    "Estimate; WORLD REGION OF BIRTH OF FOREIGN BORN - Foreign-born population excluding population born at sea - "
+    "Latin America",
+    "Estimate; LANGUAGE SPOKEN AT HOME AND ABILITY TO SPEAK ENGLISH - Population 5 years and over - Language other "
+    "than English",
+    "Estimate; EMPLOYMENT STATUS - Population 16 years and over - In labor force - Civilian labor force - Unemployed",
+    "Estimate; COMMUTING TO WORK - Workers 16 years and over - Public transportation (excluding taxicab)",
+    "Estimate; HEALTH INSURANCE COVERAGE - Civilian noninstitutionalized population - No health insurance coverage",
+    "Estimate; POVERTY RATES FOR FAMILIES AND PEOPLE FOR WHOM POVERTY STATUS IS DETERMINED - All people",
+    "Estimate; OWNER CHARACTERISTICS - Owner-occupied housing units - Median value (dollars)",
+    "Estimate; INCOME IN THE PAST 12 MONTHS (IN {year} INFLATION-ADJUSTED DOLLARS) - Households - Median household "
+    "income (dollars)",
+    "Estimate; INCOME IN THE PAST 12 MONTHS (IN {year} INFLATION-ADJUSTED DOLLARS) - With Food Stamp/SNAP benefits"]
+
+def acs_columns(year):
+    '''ACS S0201 columns of the demographic features in the survey of one year.
+    arguments:
+        year -- year of the survey (int)
+    returns:
+        map from the raw column names to the feature names of ACS_FEATURES (dict)
+    '''
+    columns = ACS_COLUMNS_10_12 if year < 2014 else ACS_COLUMNS_14
+    return {column.format(year=year): feature for column, feature in zip(columns, ACS_FEATURES)}
+
+def acs_features(acsFiles, relabel=None, n_jobs=None):
+    '''Demographic features of ACS_Demographics_Processing.ipynb, one row per district and election.
+    arguments:
+        acsFiles -- file paths of ACS S0201 data, the year is parsed from the file name (list)
+        relabel -- election year each survey year stands in for, None uses the 2017 survey for 2018 (dict)
+        n_jobs -- see load_demographics() (int)
+    returns:
+        wide dataframe indexed ST_DD_YYYY, values are numeric and entries like '1,000,000+' or '(X)' are nan
+        (pandas.dataframe)
+    '''
+    if relabel is None:
+        relabel = {2017: 2018}
+    years = [2000 + int(re.search(r'ACS_(\d{2})_', os.path.basename(relFilePath)).group(1)) for relFilePath in acsFiles]
+    renames = {}
+    for year in set(years):
+        renames.update(acs_columns(year))
+    #the 2010-2012 and 2014+ names of a feature never collide, so every file can read the union of them
+    long_df = load_demographics(acsFiles=acsFiles, columns=list(renames), renames=renames, numeric=True, n_jobs=n_jobs)
+    long_df['year'] = long_df['year'].replace(relabel)
+    long_df['key'] = hfunc.frame_key(long_df)
+    wide = pivot_demographics(long_df)[['state', 'district', 'year'] + ACS_FEATURES]
+
+    wide['foreign_to_native_born_ratio'] = wide['foreign_born_population']/wide['native_born_population']
+    return wide.drop(['native_born_population', 'foreign_born_population'], axis=1)
+
+def join_demographics(fec, demographics, impute_year=None):
+    '''Add the demographic features to a dataset.
+    arguments:
+        fec -- dataset indexed ST_DD_YYYY, e.g. Datasets/data_FEC_NATIONALPOLL_2004_2018.p (pandas.dataframe)
+        demographics -- output of acs_features() (pandas.dataframe)
+        impute_year -- None keeps only the rows with demographics (the DEMOGRAPHICS datasets). Otherwise every row
+                       is kept, sorted by index, and rows before impute_year take the demographics of the same
+                       district in impute_year (the DEMOGRAPHICSIMPUTED datasets, impute_year=2010) (int)
+    returns:
+        dataset with the demographic features (pandas.dataframe)
+    '''
+    features = demographics.drop(['state', 'district', 'year'], axis=1)
+    if impute_year is None:
+        return fec.join(features, how='inner')
+
+    dataset = fec.join(features, how='left').sort_index()
+    early = (dataset['year'] < impute_year).values
+    same_district = hfunc.key_to_index(hfunc.index_to_key(dataset.index[early]) - dataset['year'].values[early]
+                                       + impute_year)
+    dataset.loc[early, features.columns] = features.reindex(same_district).values
+    return dataset
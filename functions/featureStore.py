@@ -0,0 +1,351 @@
+import os
+import json
+import shutil
+import pickle
+import hashlib
+import warnings
+import pandas as pd
+import numpy as np
+from functions import houseFunctions as hfunc
+'''
+Columnar on-disk store for the Datasets/*.p dataframes.
+
+Every column of every year partition is one .npy file, opened with memory mapping so a read only touches the
+columns and years asked for. Columns holding python objects other than numbers and strings (dicts, geometries)
+are pickled to a .p file per partition instead. A json manifest records the format version, column types and a
+sha256 of every file, and the sha256 of the pickle the store was built from: load_frame() reads the pickle instead
+of a store that is older than it.
+
+layout:
+    <storePath>/manifest.json
+    <storePath>/year=2004/<column>.npy
+    ...
+'''
+
+FORMAT_VERSION = 1
+MANIFEST = 'manifest.json'
+ROW_COL = '__row__'
+INDEX_COL = '__index__'
+#(path, size, mtime) of the files whose hash has already been checked against a manifest
+_verified = set()
+#sha256 of the pickles, keyed by (path, size, mtime)
+_pickle_hashes = {}
+
+def store_path(relFilePath, storeDir=None):
+    '''Default location of the store built from a pickle, e.g. Datasets/data.p -> Datasets/store/data
+    arguments:
+        relFilePath -- path to the pickled dataframe (str)
+        storeDir -- directory holding the stores, defaults to a 'store' folder next to the pickle (str)
+    returns:
+        path to the store (str)
+    '''
+    folder, fileName = os.path.split(relFilePath)
+    if storeDir is None:
+        storeDir = os.path.join(folder, 'store')
+    return os.path.join(storeDir, os.path.splitext(fileName)[0])
+
+def file_hash(relFilePath):
+    '''sha256 of a file, read in blocks.
+    arguments:
+        relFilePath -- path to the file (str)
+    returns:
+        hex digest (str)
+    '''
+    digest = hashlib.sha256()
+    with open(relFilePath, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def encode_column(values):
+    '''Split a column into the arrays stored on disk.
+    arguments:
+        values -- column to encode (pandas.series)
+    returns:
+        column metadata for the manifest (dict)
+        arrays to save, keyed by file suffix (dict)
+    '''
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        values = values.astype(object)
+    if values.dtype.kind in 'biufmM':
+        return {'kind': 'numeric', 'dtype': str(values.dtype)}, {'': values.values}
+
+    #object and string columns: strings -> category codes, numbers -> float, a mix of both is kept as both.
+    #anything else (e.g. the overlap dicts and centroids of all_overlap_data.p) is pickled as it is
+    is_text = values.map(lambda x: isinstance(x, str)).values.astype(bool)
+    is_number = values.map(lambda x: isinstance(x, (int, float, np.number))).values
+    if (~is_text & ~is_number.astype(bool) & values.notnull().values).any():
+        return {'kind': 'pickle'}, {'': np.asarray(values.values, dtype=object)}
+    numbers = pd.to_numeric(values, errors='coerce')
+    if not is_text.any():
+        return {'kind': 'numeric', 'dtype': 'float64'}, {'': numbers.values.astype(float)}
+
+    categories, codes = np.unique(values[is_text].astype(str).values, return_inverse=True)
+    all_codes = np.full(len(values), -1, dtype=np.int32)
+    all_codes[is_text] = codes
+    if is_text.sum() == values.notnull().sum():
+        return {'kind': 'category', 'categories': categories.tolist()}, {'': all_codes}
+    return {'kind': 'mixed', 'categories': categories.tolist()}, {'': numbers.values.astype(float), '.codes': all_codes}
+
+def decode_column(meta, arrays):
+    '''Inverse of encode_column().
+    arguments:
+        meta -- column metadata from the manifest (dict)
+        arrays -- arrays read from disk, keyed by file suffix (dict)
+    returns:
+        column values (numpy.array or pandas.categorical)
+    '''
+    if meta['kind'] in ('numeric', 'pickle'):
+        return arrays['']
+    if meta['kind'] == 'category':
+        return pd.Categorical.from_codes(arrays[''], meta['categories'])
+    values = arrays[''].astype(object)
+    codes = arrays['.codes']
+    values[codes >= 0] = np.array(meta['categories'], dtype=object)[codes[codes >= 0]]
+    return values
+
+def write_store(df, storePath, partition_col='year', overwrite=False, sourcePath=None):
+    '''Write a dataframe to a columnar store partitioned by year.
+    arguments:
+        df -- dataframe to store, an ST_DD_YYYY index is stored as integer keys (pandas.dataframe)
+        storePath -- directory of the store (str)
+        partition_col -- column to partition the files by (str)
+        overwrite -- replace an existing store at storePath (bool)
+        sourcePath -- pickle holding the same dataframe, its sha256 is recorded so load_frame() can tell when the
+                      store is older than the pickle (str)
+    returns:
+        manifest of the store (dict)
+    '''
+    if os.path.exists(storePath):
+        if not overwrite:
+            raise FileExistsError('{} already exists, pass overwrite=True to replace it'.format(storePath))
+        shutil.rmtree(storePath)
+
+    df = df.copy()
+    if INDEX_COL in df.columns or ROW_COL in df.columns:
+        raise ValueError('{} and {} are reserved column names'.format(INDEX_COL, ROW_COL))
+    #keep the index as integer keys when it is the usual ST_DD_YYYY index, as plain strings otherwise
+    index_kind = None
+    if not isinstance(df.index, pd.RangeIndex):
+        try:
+            df[INDEX_COL] = hfunc.index_to_key(df.index)
+            index_kind = 'key'
+        except (ValueError, KeyError, TypeError, AttributeError):
+            df[INDEX_COL] = np.asarray(df.index)
+            index_kind = 'plain'
+    df[ROW_COL] = np.arange(len(df), dtype=np.int64)
+
+    manifest = {'format_version': FORMAT_VERSION, 'partition_col': partition_col, 'rows': len(df),
+                'index': index_kind, 'columns': [], 'partitions': [],
+                'source_sha256': None if sourcePath is None else pickle_hash(sourcePath)}
+    #encode whole columns once so every partition shares the same categories
+    encoded = {}
+    for col in df.columns:
+        meta, encoded[col] = encode_column(df[col])
+        manifest['columns'].append(dict(name=col, source_dtype=str(df[col].dtype), **meta))
+
+    partitions = df.groupby(partition_col, sort=True, dropna=False).indices
+    for value, rows in sorted(partitions.items(), key=lambda item: (pd.isnull(item[0]), item[0])):
+        value = None if pd.isnull(value) else value.item() if hasattr(value, 'item') else value
+        folder = '{}={}'.format(partition_col, 'null' if value is None else value)
+        os.makedirs(os.path.join(storePath, folder))
+        files = {}
+        for col, arrays in encoded.items():
+            for suffix, array in arrays.items():
+                if array.dtype == object:
+                    relName = os.path.join(folder, '{}{}.p'.format(col, suffix))
+                    with open(os.path.join(storePath, relName), 'wb') as f:
+                        pickle.dump(array[rows], f)
+                else:
+                    relName = os.path.join(folder, '{}{}.npy'.format(col, suffix))
+                    np.save(os.path.join(storePath, relName), np.ascontiguousarray(array[rows]), allow_pickle=False)
+                files[col + suffix] = {'file': relName, 'sha256': file_hash(os.path.join(storePath, relName))}
+        manifest['partitions'].append({'value': value, 'rows': len(rows), 'files': files})
+
+    #the manifest goes last, a store without one is incomplete
+    with open(os.path.join(storePath, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=1)
+    return manifest
+
+def read_manifest(storePath):
+    '''Read and check the manifest of a store.
+    arguments:
+        storePath -- directory of the store (str)
+    returns:
+        manifest of the store (dict)
+    '''
+    with open(os.path.join(storePath, MANIFEST)) as f:
+        manifest = json.load(f)
+    if manifest.get('format_version') != FORMAT_VERSION:
+        raise ValueError('{} has store format {}, this code reads format {}'.format(
+            storePath, manifest.get('format_version'), FORMAT_VERSION))
+    return manifest
+
+def read_store(storePath, columns=None, years=None, string_index=True, verify=True):
+    '''Read a dataframe back from a store. Only the requested columns of the requested partitions are opened.
+    Files are memory mapped, a read of a single partition hands the mapped arrays to pandas without copying.
+    arguments:
+        storePath -- directory of the store (str)
+        columns -- columns to read, None reads all of them (list)
+        years -- partition values to read, None reads all of them (list)
+        string_index -- rebuild the legacy ST_DD_YYYY index from the stored integer keys (bool)
+        verify -- check the sha256 of every file that is opened, once per file until its size or mtime changes (bool)
+    returns:
+        dataframe with the requested columns and rows, in the order they were written. Columns come back with the
+        dtype they were written with, as the pickle gives them (pandas.dataframe)
+    '''
+    manifest = read_manifest(storePath)
+    metas = {meta['name']: meta for meta in manifest['columns']}
+    if columns is None:
+        columns = [name for name in metas if name not in (INDEX_COL, ROW_COL)]
+    missing = [col for col in columns if col not in metas]
+    if missing:
+        raise KeyError('columns not in store {}: {}'.format(storePath, missing))
+    wanted = list(columns) + [col for col in (INDEX_COL, ROW_COL) if col in metas]
+
+    partitions = manifest['partitions']
+    if years is not None:
+        years = set(years)
+        partitions = [part for part in partitions if part['value'] in years]
+
+    def load(part, fileKey):
+        entry = part['files'][fileKey]
+        relName = os.path.join(storePath, entry['file'])
+        if verify:
+            stat = os.stat(relName)
+            fileId = (os.path.abspath(relName), stat.st_size, stat.st_mtime_ns, entry['sha256'])
+            if fileId not in _verified:
+                if file_hash(relName) != entry['sha256']:
+                    raise ValueError('{} does not match the hash in the manifest, the store is corrupt'.format(relName))
+                _verified.add(fileId)
+        if relName.endswith('.p'):
+            with open(relName, 'rb') as f:
+                return pickle.load(f)
+        return np.load(relName, mmap_mode='r', allow_pickle=False)
+
+    data = {}
+    for col in wanted:
+        suffixes = ['', '.codes'] if metas[col]['kind'] == 'mixed' else ['']
+        arrays = {}
+        for suffix in suffixes:
+            pieces = [load(part, col + suffix) for part in partitions]
+            if len(pieces) == 1:
+                arrays[suffix] = pieces[0]
+            elif pieces:
+                arrays[suffix] = np.concatenate(pieces)
+            else:
+                is_codes = suffix == '.codes' or metas[col]['kind'] == 'category'
+                dtype = np.int32 if is_codes else object if metas[col]['kind'] == 'pickle' else metas[col].get('dtype', 'float64')
+                arrays[suffix] = np.empty(0, dtype=dtype)
+        data[col] = decode_column(metas[col], arrays)
+
+    #partitions split the original row order, put it back
+    rows = data.pop(ROW_COL)
+    order = None
+    if len(partitions) > 1 and (np.diff(rows) < 0).any():
+        order = np.argsort(rows, kind='mergesort')
+        data = {col: values[order] for col, values in data.items()}
+
+    index = None
+    if INDEX_COL in data:
+        index = data.pop(INDEX_COL)
+        if manifest['index'] == 'key':
+            index = hfunc.key_to_index(index) if string_index else pd.Index(index, name='key')
+        else:
+            index = pd.Index(np.asarray(index))
+    df = pd.DataFrame(data, index=index, columns=list(columns), copy=False)
+    #string columns are stored as category codes and numbers in object columns as floats, hand them back with the
+    #dtype they were written with
+    for col in columns:
+        source_dtype = metas[col].get('source_dtype')
+        if source_dtype is not None and str(df[col].dtype) != source_dtype:
+            df[col] = df[col].astype(source_dtype)
+    return df
+
+def convert_pickle(relFilePath, storePath=None, partition_col='year', overwrite=False):
+    '''Build the store of a pickled dataframe.
+    arguments:
+        relFilePath -- path to the pickled dataframe (str)
+        storePath -- directory of the store, defaults to store_path(relFilePath) (str)
+        partition_col -- column to partition the files by (str)
+        overwrite -- replace an existing store (bool)
+    returns:
+        manifest of the store (dict)
+    '''
+    if storePath is None:
+        storePath = store_path(relFilePath)
+    df = pickle.load(open(relFilePath, 'rb'))
+    return write_store(df, storePath, partition_col=partition_col, overwrite=overwrite, sourcePath=relFilePath)
+
+def pickle_hash(relFilePath):
+    '''sha256 of a pickle, remembered while its size and modification time stay the same.
+    arguments:
+        relFilePath -- path to the pickle (str)
+    returns:
+        hex digest (str)
+    '''
+    stat = os.stat(relFilePath)
+    fileId = (os.path.abspath(relFilePath), stat.st_size, stat.st_mtime_ns)
+    if fileId not in _pickle_hashes:
+        _pickle_hashes[fileId] = file_hash(relFilePath)
+    return _pickle_hashes[fileId]
+
+def store_is_current(relFilePath, storePath=None):
+    '''Whether a dataset has a store that was built from its pickle as it is now. A store whose pickle is gone
+    counts as current, a store that does not record its pickle (built by write_store() without sourcePath) does not.
+    arguments:
+        relFilePath -- path to the pickled dataframe (str)
+        storePath -- directory of the store, defaults to store_path(relFilePath) (str)
+    returns:
+        True if load_frame() reads the store (bool)
+    '''
+    if storePath is None:
+        storePath = store_path(relFilePath)
+    if not os.path.exists(os.path.join(storePath, MANIFEST)):
+        return False
+    if not os.path.exists(relFilePath):
+        return True
+    if read_manifest(storePath).get('source_sha256') == pickle_hash(relFilePath):
+        return True
+    warnings.warn('the store {} was not built from {} as it is now, reading the pickle. Rebuild the store with '
+                  'convert_pickle(..., overwrite=True)'.format(storePath, relFilePath))
+    return False
+
+def source_hash(relFilePath, storePath=None):
+    '''sha256 of the data load_frame() reads for a dataset: the store manifest when it reads the store (the manifest
+    holds the hash of every column file), the pickle otherwise.
+    arguments:
+        relFilePath -- path to the pickled dataframe (str)
+        storePath -- directory of the store, defaults to store_path(relFilePath) (str)
+    returns:
+        hex digest (str)
+    '''
+    if storePath is None:
+        storePath = store_path(relFilePath)
+    if store_is_current(relFilePath, storePath):
+        return file_hash(os.path.join(storePath, MANIFEST))
+    return pickle_hash(relFilePath)
+
+def load_frame(relFilePath, columns=None, years=None, string_index=True, storePath=None):
+    '''Load a dataset through its store when one has been built from the pickle as it is now, from the pickle
+    otherwise. Both give the same columns with the same dtypes.
+    arguments:
+        relFilePath -- path to the pickled dataframe (str)
+        columns -- columns to read, None reads all of them (list)
+        years -- years to read, None reads all of them (list)
+        string_index -- see read_store() (bool)
+        storePath -- directory of the store, defaults to store_path(relFilePath) (str)
+    returns:
+        dataframe with the requested columns and years (pandas.dataframe)
+    '''
+    if storePath is None:
+        storePath = store_path(relFilePath)
+    if store_is_current(relFilePath, storePath):
+        return read_store(storePath, columns=columns, years=years, string_index=string_index)
+
+    df = pickle.load(open(relFilePath, 'rb'))
+    if years is not None:
+        df = df[df['year'].isin(years)]
+    if columns is not None:
+        df = df[list(columns)]
+    return df
@@ -9,31 +9,132 @@ Parse 1976-2016 house data from https://dataverse.harvard.edu/dataset.xhtml?pers
 @return:  dataframe indexed by (year, state, district)
 '''
 
-def load_data(relFilePath, minYear=2010):
+#state abbreviations and their fips codes, the fips code is the state part of the integer district key
+state_abbrs = np.array(['AL','AK','AZ','AR','CA','CO','CT','DE','DC','FL','GA','HI','ID','IL',
+              'IN','IA','KS','KY','LA','ME','MD','MA','MI','MN','MS','MO','MT',
+              'NE','NV','NH','NJ','NM','NY','NC','ND','OH','OK','OR','PA','RI',
+              'SC','SD','TN','TX','UT','VT','VA','WA','WV','WI','WY'])
+
+#full state names as the wikipedia tables and the UCLA shapefiles spell them, in the order of state_abbrs
+state_names = np.array(['ALABAMA', 'ALASKA', 'ARIZONA', 'ARKANSAS', 'CALIFORNIA', 'COLORADO', 'CONNECTICUT',
+                        'DELAWARE', 'DISTRICT OF COLUMBIA', 'FLORIDA', 'GEORGIA', 'HAWAII', 'IDAHO', 'ILLINOIS',
+                        'INDIANA', 'IOWA', 'KANSAS', 'KENTUCKY', 'LOUISIANA', 'MAINE', 'MARYLAND', 'MASSACHUSETTS',
+                        'MICHIGAN', 'MINNESOTA', 'MISSISSIPPI', 'MISSOURI', 'MONTANA', 'NEBRASKA', 'NEVADA',
+                        'NEW HAMPSHIRE', 'NEW JERSEY', 'NEW MEXICO', 'NEW YORK', 'NORTH CAROLINA', 'NORTH DAKOTA',
+                        'OHIO', 'OKLAHOMA', 'OREGON', 'PENNSYLVANIA', 'RHODE ISLAND', 'SOUTH CAROLINA',
+                        'SOUTH DAKOTA', 'TENNESSEE', 'TEXAS', 'UTAH', 'VERMONT', 'VIRGINIA', 'WASHINGTON',
+                        'WEST VIRGINIA', 'WISCONSIN', 'WYOMING'])
+
+state_fips = np.array([1, 2, 4, 5, 6, 8, 9, 10, 11, 12, 13, 15, 16, 17, 18, 19, 20, 21, 22, 23,
+                       24, 25, 26, 27, 28, 29, 30, 31, 32, 33, 34, 35, 36, 37, 38, 39, 40,
+                       41, 42, 44, 45, 46, 47, 48, 49, 50, 51, 53, 54, 55, 56])
+
+def load_data(relFilePath, minYear=2010, maxYear=None, chunksize=100000):
     ''' Keep only the winner and 2nd place candidates within each state's district for every year.
     arguments:
         relFilePath -- path to the data file (csv)
         minYear -- only records for all years from and after the min year will be kept (int)
+        maxYear -- only records for all years up to and including the max year will be kept, None keeps everything (int)
+        chunksize -- number of csv rows parsed at a time, the year filter is applied to every chunk as it is read (int)
     returns:
         dataframe with only the winners (pandas.dataframe)
         dataframe with only the 2nd place candidates (pandas.dataframe)
     '''
 
-    data_df = pd.read_csv(relFilePath)
-
-    winners_df = pd.DataFrame()
-    winners2_df = pd.DataFrame()
-    for key, shard in data_df.groupby(['year', 'state_po', 'district']):        
-        if int(key[0]) >= minYear:
-            #convention: 2nd winner = 1st winner if only 1 player
-            winners_df = winners_df.append(shard.loc[shard['candidatevotes'].idxmax()])
-            sortedIndices = (shard['candidatevotes'].values.argsort()[::-1])
-            if len(sortedIndices) > 1:
-                winners2_df = winners2_df.append(shard.iloc[sortedIndices[1]])
-            else:
-                winners2_df = winners2_df.append(shard.iloc[sortedIndices[0]])
+    #push the year filter down to the read so out-of-range races are never accumulated
+    shards = []
+    for chunk in pd.read_csv(relFilePath, chunksize=chunksize):
+        keep = chunk['year'] >= minYear
+        if maxYear is not None:
+            keep &= chunk['year'] <= maxYear
+        shards.append(chunk[keep])
+    data_df = pd.concat(shards)
+
+    keys = ['year', 'state_po', 'district']
+    #rank candidates within every race in one pass, most votes first
+    #stable sort so ties keep file order (same pick as idxmax)
+    ranked = data_df.sort_values('candidatevotes', ascending=False, kind='mergesort')
+    rank = ranked.groupby(keys, sort=False).cumcount()
+
+    winners_df = ranked[rank == 0]
+    #convention: 2nd winner = 1st winner if only 1 player
+    #last of the top two rows is the runner-up, or the winner itself for single candidate races
+    winners2_df = ranked[rank <= 1].groupby(keys, sort=False).tail(1)
+
+    winners_df = winners_df.sort_values(keys, kind='mergesort')
+    winners2_df = winners2_df.sort_values(keys, kind='mergesort')
     return winners_df, winners2_df
 
+def encode_key(state, district, year):
+    '''Pack state, district and year into a single integer key of the form FFDDYYYY, where FF is the state fips code.
+    e.g. AL_01_2002 -> 1012002, WI_04_2016 -> 55042016
+    arguments:
+        state -- state abbreviations (array-like of str)
+        district -- district numbers (array-like of ints)
+        year -- election years (array-like of ints)
+    returns:
+        integer keys (numpy.array of int64)
+    '''
+    codes = pd.Index(state_abbrs).get_indexer(np.asarray(state, dtype=object))
+    if (codes < 0).any():
+        raise ValueError('unknown state abbreviation(s): {}'.format(sorted(set(np.asarray(state, dtype=object)[codes < 0]))))
+    district = np.asarray(district).astype(np.int64)
+    year = np.asarray(year).astype(np.int64)
+    return state_fips[codes].astype(np.int64)*1000000 + district*10000 + year
+
+def decode_key(key):
+    '''Unpack integer keys made by encode_key().
+    arguments:
+        key -- integer keys (array-like of ints)
+    returns:
+        state abbreviations (numpy.array of str)
+        district numbers (numpy.array of int64)
+        election years (numpy.array of int64)
+    '''
+    key = np.asarray(key).astype(np.int64)
+    fips_to_abbr = np.empty(state_fips.max()+1, dtype=object)
+    fips_to_abbr[state_fips] = state_abbrs
+    return fips_to_abbr[key//1000000], (key//10000)%100, key%10000
+
+def key_to_index(key):
+    '''Convert integer keys to the legacy ST_DD_YYYY string index.
+    arguments:
+        key -- integer keys (array-like of ints)
+    returns:
+        legacy string index (pandas.Index)
+    '''
+    state, district, year = decode_key(key)
+    return pd.Index(pd.Series(state, dtype=object) + '_' + pd.Series(district).astype(str).str.zfill(2) + '_' + pd.Series(year).astype(str))
+
+def index_to_key(index):
+    '''Convert the legacy ST_DD_YYYY string index to integer keys.
+    arguments:
+        index -- legacy string index (array-like of str)
+    returns:
+        integer keys (numpy.array of int64)
+    '''
+    parts = pd.Series(np.asarray(index, dtype=object)).str.split('_', expand=True)
+    return encode_key(parts[0].values, parts[1].astype(int).values, parts[2].astype(int).values)
+
+def previous_key(key, lag=2):
+    '''Key of the same district some years earlier. The year sits in the lowest digits so this is a plain subtraction.
+    arguments:
+        key -- integer keys (array-like of ints)
+        lag -- number of years to look back (int)
+    returns:
+        integer keys (numpy.array of int64)
+    '''
+    return np.asarray(key).astype(np.int64) - lag
+
+def frame_key(df):
+    '''Integer keys of every row of a dataframe.
+    arguments:
+        df -- dataframe with the columns 'district', 'state' and 'year' (pandas.dataframe)
+    returns:
+        integer keys (numpy.array of int64)
+    '''
+    return encode_key(df['state'].values, df['district'].values, df['year'].values)
+
 def clean_index(df, clean_before_build=True):
     '''Performs general clean up tasks on the key columns. Generates the master key.
     arguments:
@@ -51,15 +152,19 @@ def clean_index(df, clean_before_build=True):
     #make sure all districts start with 1
     df.loc[df['district']==0, 'district'] = 1
 
-    # glue together the columns to get a more descriptive index    
-    df.index = ['{0}_{1:02d}_{2}'.format(row['state'],row['district'],row['year']) for _,row in df.iterrows()]
+    # glue together the columns to get a more descriptive index
+    df.index = df['state'].astype(str) + '_' + df['district'].astype(str).str.zfill(2) + '_' + df['year'].astype(str)
 
     return df
 
-def fetch_index(df, df2, save=False, load=False):
+def fetch_index(df, df2, save=False, load=False, string_index=True, relFilePath='Datasets/master_index.p'):
     '''Helper function for generating/loading master index for syncing between data sources.
+    The pickle keeps the legacy ST_DD_YYYY string index, files keyed by the integer keys of encode_key() load too.
     arguments:
         df -- dataframe to parse index from, MUST CONTAIN FULL COPIES OF THE 'district', 'state_po', 'year' COLUMNS (pandas.dataframe)
+        string_index -- return the master index with the legacy ST_DD_YYYY string index, False returns it keyed by
+                        the integer keys of encode_key() (bool)
+        relFilePath -- path to the master index pickle (str)
     returns:
         dataframe with master index for syncing between data sources.
     '''
@@ -69,21 +174,141 @@ def fetch_index(df, df2, save=False, load=False):
         tmp1 = df[['district', 'state', 'year']]
         tmp2 = df2[['district', 'state', 'year']]
         master_index = pd.concat([tmp1, tmp2])
+        master_index.index = pd.Index(frame_key(master_index), name='key')
 
         if save:
-            pickle.dump(master_index, open('Datasets/master_index.p', 'wb'))
-        return master_index
+            save_index(master_index, relFilePath)
 
     else:
-        master_index = pickle.load(open('Datasets/master_index.p', 'rb'))
-        return master_index    
+        master_index = pickle.load(open(relFilePath, 'rb'))
+        if not pd.api.types.is_integer_dtype(master_index.index):
+            master_index.index = pd.Index(index_to_key(master_index.index), name='key')
+
+    if string_index:
+        master_index = master_index.copy()
+        master_index.index = key_to_index(master_index.index)
+    return master_index
+
+def save_index(master_index, relFilePath='Datasets/master_index.p'):
+    '''Pickle the master index with the legacy ST_DD_YYYY string index, as fetch_index() always has.
+    arguments:
+        master_index -- master index keyed by integer keys or by ST_DD_YYYY (pandas.dataframe)
+        relFilePath -- path to the master index pickle (str)
+    '''
+    if pd.api.types.is_integer_dtype(master_index.index):
+        master_index = master_index.set_axis(key_to_index(master_index.index), axis=0)
+    pickle.dump(master_index, open(relFilePath, 'wb'))
 
-def fetch_trimmed_data(df1, df2, minYear=2012):
+def lag_label(name, lag):
+    '''Column name of a lag feature. t-2 features keep their historical names, other lags get a _tmN suffix.
+    arguments:
+        name -- name of the t-2 feature (str)
+        lag -- number of years looked back (int)
+    returns:
+        column name for the lag (str)
+    '''
+    if lag == 2:
+        return name
+    return '{}_tm{}'.format(name, lag)
+
+def lag_lookup(source, df, cols, lag=2):
+    '''Fetch columns of the same district some years earlier for every row of df at once.
+    arguments:
+        source -- dataframe to look up, should contain the columns 'district', 'state' and 'year' (pandas.dataframe)
+        df -- dataframe with the rows to find, should contain the columns 'district', 'state' and 'year' (pandas.dataframe)
+        cols -- columns of source to fetch (list)
+        lag -- number of years to look back, 0 fetches the same election (int)
+    returns:
+        dataframe with the fetched columns, one row per row of df in the same order, nan where source has no match (pandas.dataframe)
+    '''
+    #first match wins, same as the .values[0] lookups this replaces
+    source_key = frame_key(source)
+    first = ~pd.Index(source_key).duplicated(keep='first')
+    source = source.loc[first, cols].set_axis(pd.Index(source_key[first]))
+    return source.reindex(previous_key(frame_key(df), lag))
+
+def poll_lookup(poll, df, lag=2):
+    '''National poll of the election some years before each row of df.
+    arguments:
+        poll -- national poll of every race with the columns 'district', 'state', 'year' and 'national_poll'
+                (pandas.dataframe), or one value per election year, e.g. a column of pollFunctions.poll_table()
+                (pandas.series indexed by year)
+        df -- dataframe with the rows to find, should contain the columns 'district', 'state' and 'year' (pandas.dataframe)
+        lag -- number of years to look back, 0 fetches the same election (int)
+    returns:
+        national poll of every row of df, nan where poll has no match (numpy.array)
+    '''
+    if isinstance(poll, pd.Series):
+        return (df['year'] - lag).map(poll).values.astype(float)
+    return lag_lookup(poll, df, ['national_poll'], lag=lag)['national_poll'].values
+
+def lag_features(df, history, df2, poll, lag=2):
+    '''Compute the polling, previous winner and margin features of one lag for every row of df in one pass.
+    arguments:
+        df -- dataframe with the rows to compute features for (pandas.dataframe)
+        history -- dataframe with the winners of every race, looked up at t-lag (pandas.dataframe)
+        df2 -- dataframe with 2nd place candidates for each race, looked up at t-lag (pandas.dataframe)
+        poll -- national poll of every race or of every year, see poll_lookup() (pandas.dataframe or pandas.series)
+        lag -- number of years to look back (int)
+    returns:
+        dataframe with the lag features, indexed like df (pandas.dataframe)
+    '''
+    features = pd.DataFrame(index=df.index)
+
+    #################### POLLING FEATURES ####################
+    poll_t = poll_lookup(poll, df, lag=0)
+    poll_tm = poll_lookup(poll, df, lag=lag)
+    features[lag_label('national_poll_prev', lag)] = poll_tm
+    features[lag_label('national_poll_delta_subtract', lag)] = poll_t - poll_tm
+    with np.errstate(divide='ignore', invalid='ignore'):
+        features[lag_label('national_poll_delta_divide', lag)] = poll_t/poll_tm
+    #################### POLLING FEATURES ####################
+
+    #################### PREVIOUS WINNERS ####################
+    winner = lag_lookup(history, df, ['party', 'candidatevotes', 'totalvotes'], lag=lag)
+    loser = lag_lookup(df2, df, ['candidatevotes', 'totalvotes'], lag=lag)
+    party = winner['party'].values
+    features[lag_label('previous_party', lag)] = party
+    #################### PREVIOUS WINNERS ####################
+
+    #################### MARGIN FEATURES ####################
+    #convention: when signed, always defined as dem +ve and rep -ve
+    winner_votes = winner['candidatevotes'].values.astype(float)
+    winner_totalvotes = winner['totalvotes'].values.astype(float)
+    loser_votes = loser['candidatevotes'].values.astype(float)
+    loser_totalvotes = loser['totalvotes'].values.astype(float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        winner_margin = np.where(winner_totalvotes == 0, 1., winner_votes/winner_totalvotes)
+        loser_margin = np.where(loser_totalvotes == 0, 1., loser_votes/loser_totalvotes)
+        ### see convention for 2nd winner when only 1 player ###
+        loser_margin = np.where(winner_margin == loser_margin, 1e-10, loser_votes/loser_totalvotes)
+
+        dem = party == 'democrat'
+        rep = party == 'republican'
+        safe_winner = np.where(winner_margin != 0, winner_margin, 1e-10)
+        safe_loser = np.where(loser_margin != 0, loser_margin, 1e-10)
+
+        #signed features are only defined if the previous winner was a democrat or a republican
+        features[lag_label('dem_win_margin_prev', lag)] = np.where(dem, winner_margin, np.where(rep, loser_margin, np.nan))
+        features[lag_label('rep_win_margin_prev', lag)] = np.where(dem, loser_margin, np.where(rep, winner_margin, np.nan))
+        features[lag_label('margin_signed_minus_prev', lag)] = np.where(dem, winner_margin - loser_margin,
+                                                                        np.where(rep, loser_margin - winner_margin, np.nan))
+        features[lag_label('margin_signed_divide_prev', lag)] = np.where(dem, winner_margin/safe_loser,
+                                                                         np.where(rep, loser_margin/safe_winner, np.nan))
+        features[lag_label('margin_unsigned_minus_prev', lag)] = winner_margin - loser_margin
+        features[lag_label('margin_unsigned_divide_prev', lag)] = winner_margin/safe_loser
+    #################### MARGIN FEATURES ####################
+
+    return features
+
+def fetch_trimmed_data(df1, df2, minYear=2012, lags=(2,), poll=None):
     '''Compile training data. Additional cleaning and processing to generate additional features.
     arguments:
         df1 -- dataframe to compile training data from, should be loaded through load_data() and cleaned with clean_index()
         df2 -- dataframe with 2nd place candidates for each race
         minYear -- only records for all years from and after the min year will be kept (int)
+        lags -- years to look back for the lag features, t-2 keeps the historical column names (tuple of ints)
+        poll -- national poll, see poll_lookup(). None loads Datasets/national_poll.p
     returns:
         dataframe containing training data.
     '''
@@ -205,104 +430,39 @@ def fetch_trimmed_data(df1, df2, minYear=2012):
     ########################################## ADDITIONAL PROCESSING W. ASSUMPTIONS ##########################################
     
 
-    poll = pickle.load(open('Datasets/national_poll.p', 'rb'))
-    for year in range(minYear, int(max(df1['year'].values))+1, 2):
-        #convention: t-> current election, t-2 (tm2) -> previous election
-        for index_t, row in df1.iterrows():
-            if row['year'] == year:
-                index_tm2 = index_t.replace(str(year), str(year-2))
-                if index_tm2 in df1.index:
-                    #a district is dropped if it does not exist in all years being processed (implictly assuming districts are the same shape across all years)
-
-                    #################### POLLING FEATURES ####################
-                    poll_t = poll.loc[poll.index == index_t, 'national_poll'].values[0]
-                    poll_tm2 = poll.loc[poll.index == index_tm2, 'national_poll'].values[0]
-                    df1.loc[df1.index == index_t, 'national_poll'] = poll_t
-                    df1.loc[df1.index == index_t, 'national_poll_prev'] = poll_tm2
-                    df1.loc[df1.index == index_t, 'national_poll_delta_subtract'] = poll_t - poll_tm2
-                    df1.loc[df1.index == index_t, 'national_poll_delta_divide'] = poll_t/poll_tm2
-                    #################### POLLING FEATURES ####################
-
-                    #################### PREVIOUS WINNERS ####################
-                    df1.loc[df1.index == index_t, 'previous_party'] = df1.loc[df1.index == index_tm2, 'party'].values[0]
-                    #################### PREVIOUS WINNERS ####################
-
-                    
-                    #################### MARGIN FEATURES ####################
-                    #convention: when signed, always defined as dem +ve and rep -ve
-                    winner_totalvotes = df1.loc[df1.index == index_tm2, 'totalvotes'].values[0]
-                    loser_totalvotes = df2.loc[df2.index == index_tm2, 'totalvotes'].values[0]
-                    if winner_totalvotes == 0:
-                        winner_margin = 1
-                    else:
-                        winner_margin = (df1.loc[df1.index == index_tm2, 'candidatevotes'].values[0])/(winner_totalvotes)
-                    if loser_totalvotes == 0:
-                        loser_margin = 1
-                    else:
-                        loser_margin  = (df2.loc[df2.index == index_tm2, 'candidatevotes'].values[0])/(loser_totalvotes)
-
-                    if winner_margin == loser_margin:
-                        #only 1 player
-                        loser_margin = 1e-10
-                    else:
-                        loser_margin = (df2.loc[df2.index == index_tm2, 'candidatevotes'].values[0])/(df2.loc[df2.index == index_tm2, 'totalvotes'].values[0])                    
-                    ### see convention for 2nd winner when only 1 player ###
-
-                    label_dem = 'dem_win_margin_prev'
-                    label_rep = 'rep_win_margin_prev'
-                    label_sm = 'margin_signed_minus_prev'
-                    label_um = 'margin_unsigned_minus_prev'
-                    label_sd = 'margin_signed_divide_prev'
-                    label_ud = 'margin_unsigned_divide_prev'
-
-                    if df1.loc[df1.index == index_tm2, 'party'].values[0] == 'democrat':
-
-                        df1.loc[df1.index == index_t, label_dem] = winner_margin
-                        df1.loc[df1.index == index_t, label_rep] = loser_margin
-
-                        df1.loc[df1.index == index_t, label_sm] = winner_margin - loser_margin
-                        if loser_margin != 0:
-                            df1.loc[df1.index == index_t, label_sd] = winner_margin/loser_margin
-                        else:
-                            df1.loc[df1.index == index_t, label_sd] = winner_margin/(1e-10)
-
-                    elif df1.loc[df1.index == index_tm2, 'party'].values[0] == 'republican':
-
-                        df1.loc[df1.index == index_t, label_dem] = loser_margin
-                        df1.loc[df1.index == index_t, label_rep] = winner_margin
-
-                        df1.loc[df1.index == index_t, label_sm] = loser_margin - winner_margin
-                        if winner_margin != 0:
-                            df1.loc[df1.index == index_t, label_sd] = loser_margin/winner_margin
-                        else:
-                            df1.loc[df1.index == index_t, label_sd] = loser_margin/(1e-10)
-
-                    df1.loc[df1.index == index_t, label_um] = winner_margin - loser_margin
-                    if loser_margin != 0:
-                        df1.loc[df1.index == index_t, label_ud] = winner_margin/loser_margin
-                    else:
-                        df1.loc[df1.index == index_t, label_ud] = winner_margin/(1e-10)
-                        
-                        #if previous winner was democrat
-
-                    #################### MARGIN FEATURES ####################
-
-                    # to-do features
-                    # incumbent? name check
-                    # summary statistics for winning margins changing over time
-
-                else:
-                    df1 = df1[df1.index != index_t]
+    if poll is None:
+        poll = pickle.load(open('Datasets/national_poll.p', 'rb'))
+    maxYear = int(max(df1['year'].values))
+
+    #convention: t-> current election, t-2 (tm2) -> previous election
+    #a district is dropped if it does not exist in all years being processed (implictly assuming districts are the same shape across all years)
+    #i.e. a row survives only if its district has an unbroken run of elections from minYear-2 up to its own year
+    same_cycle = (df1['year'] - minYear) % 2 == 0
+    processed = same_cycle & (df1['year'] >= minYear) & (df1['year'] <= maxYear)
+    in_run = same_cycle & (df1['year'] >= minYear - 2)
+    run = df1[in_run].sort_values('year', kind='mergesort').groupby(['state', 'district']).cumcount()
+    unbroken = run == (df1.loc[in_run, 'year'] - (minYear - 2)) // 2
+    keep = ~processed | unbroken.reindex(df1.index, fill_value=False)
+    history = df1
+    df1, processed = df1[keep].copy(), processed[keep]
+
+    #################### POLLING FEATURES ####################
+    df1.loc[processed, 'national_poll'] = poll_lookup(poll, df1[processed], lag=0)
+    #################### POLLING FEATURES ####################
+
+    for lag in lags:
+        features = lag_features(df1[processed], history, df2, poll, lag)
+        for col in features.columns:
+            df1.loc[processed, col] = features[col].values
 
     #trim df1 down to only 1 election before minyear
     df1 = df1[df1['year'] != minYear - 2]
 
     #################### PREVIOUS WINNER FEATURES ####################
-    df1.loc[df1['previous_party'] == 'democrat', 'dem_win_prev'] = 1
-    df1.loc[df1['previous_party'] != 'democrat', 'dem_win_prev'] = 0
-
-    df1.loc[df1['previous_party'] == 'republican', 'rep_win_prev'] = 1
-    df1.loc[df1['previous_party'] != 'republican', 'rep_win_prev'] = 0
+    for lag in lags:
+        previous_party = df1[lag_label('previous_party', lag)]
+        df1[lag_label('dem_win_prev', lag)] = (previous_party == 'democrat')*1.
+        df1[lag_label('rep_win_prev', lag)] = (previous_party == 'republican')*1.
     #################### PREVIOUS WINNER FEATURES ####################
 
 
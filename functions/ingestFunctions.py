@@ -0,0 +1,254 @@
+import os
+import pickle
+import numpy as np
+import pandas as pd
+from functions import houseFunctions as hfunc
+from functions import pollFunctions as pfunc
+from functions import featureStore as fstore
+from functions import redistrictingFunctions as rfunc
+'''
+Incremental ingestion of one election cycle into the datasets of House-Preprocessing.ipynb,
+ACS_Demographics_Processing.ipynb and redistricting-corrections.ipynb.
+
+The winners and runners-up of every race are kept in one results pickle. A new cycle (or a new count of the
+current one, e.g. on election night) replaces only the rows of its year: in the results, in the master index and in
+every data_FEC_* dataset. Its lag, poll and redistricting features are computed from the stored previous cycle,
+nothing else is reread or recomputed.
+'''
+
+RESULTS_PATH = 'Datasets/house_results.p'
+BASE_DATASET = 'Datasets/data_FEC_NATIONALPOLL_2004_2018.p'
+DERIVED_DATASETS = ('Datasets/data_FEC_NATIONALPOLL_2004_2018_REDISTRICTDROP.p',
+                    'Datasets/data_FEC_NATIONALPOLL_DEMOGRAPHICS_2010_2018.p',
+                    'Datasets/data_FEC_NATIONALPOLL_DEMOGRAPHICS_2010_2018_REDISTRICTDROP.p',
+                    'Datasets/data_FEC_NATIONALPOLL_DEMOGRAPHICSIMPUTED_2004_2018.p',
+                    'Datasets/data_FEC_NATIONALPOLL_DEMOGRAPHICSIMPUTED_2004_2018_REDISTRICTDROP.p')
+#the DISTRICTMIXED dataset mixes the margins of redistricted districts with code that is not in this repository,
+#it has to be remade from the updated DEMOGRAPHICSIMPUTED dataset
+
+#columns of the race results that fetch_trimmed_data() reads
+RESULT_COLS = ['candidate', 'candidatevotes', 'district', 'party', 'state', 'totalvotes', 'year']
+WIKI_COLUMNS = ['location', 'PVI', 'representative', 'party', 'first_elected', 'results', 'candidates']
+CENTROID_COLS = ['longitude', 'latitude']
+
+def read_wiki_results(relFilePath, year):
+    '''Read the winners of a wikipedia table of house results, e.g. Datasets/fec/2018wiki-12072018.csv.
+    Only the winner (marked with a check mark) and its party are known, votes are left empty.
+    arguments:
+        relFilePath -- path to the wikipedia table (csv)
+        year -- election year of the table (int)
+    returns:
+        dataframe with the winner of every race, indexed ST_DD_YYYY like clean_index() (pandas.dataframe)
+    '''
+    wiki = pd.read_csv(relFilePath, header=None, names=WIKI_COLUMNS)
+    #the location is only on the first row of each race
+    wiki['location'] = wiki['location'].str.strip().ffill()
+    wiki = wiki[wiki['candidates'].str.contains('√', na=False)].sort_values('location', kind='mergesort')
+
+    #'Alabama 1' or 'Alaska at-large', often with a non-breaking space
+    location = wiki['location'].str.extract(r'^(.*\S)\s+(\S+)$')
+    state_names = location[0].str.upper()
+    codes = pd.Index(hfunc.state_names).get_indexer(state_names)
+    if (codes < 0).any():
+        raise ValueError('unknown state(s): {}'.format(sorted(set(state_names[codes < 0]))))
+    party = wiki['candidates'].str.extract(r'\(([^)]*)\)', expand=False).str.lower()
+
+    results = pd.DataFrame({'district': location[1].str.lower().replace('at-large', '1').values,
+                            'state': hfunc.state_abbrs[codes], 'year': year,
+                            'party': party.replace('democratic', 'democrat').values,
+                            'candidatevotes': None, 'totalvotes': None, 'candidate': None})
+    return hfunc.clean_index(results, clean_before_build=False)[RESULT_COLS]
+
+def save_results(winners, winners2, relFilePath=RESULTS_PATH):
+    '''Store the winners and runners-up of every race, as cleaned by houseFunctions.clean_index().
+    arguments:
+        winners -- winner of every race (pandas.dataframe)
+        winners2 -- runner-up of every race (pandas.dataframe)
+        relFilePath -- path of the results pickle (str)
+    '''
+    pickle.dump({'winners': winners[RESULT_COLS], 'winners2': winners2[RESULT_COLS]}, open(relFilePath, 'wb'))
+
+def load_results(relFilePath=RESULTS_PATH):
+    '''Load the results stored by save_results().
+    arguments:
+        relFilePath -- path of the results pickle (str)
+    returns:
+        winner of every race (pandas.dataframe)
+        runner-up of every race (pandas.dataframe)
+    '''
+    if not os.path.exists(relFilePath):
+        raise FileNotFoundError('{} is not there, run House-Preprocessing.ipynb or '
+                                '"python -m functions.pipelineFunctions results" to build it'.format(relFilePath))
+    results = pickle.load(open(relFilePath, 'rb'))
+    return results['winners'], results['winners2']
+
+def replace_year(df, rows, year):
+    '''Replace the rows of one year of a dataframe, the other rows keep their order.
+    arguments:
+        df -- dataframe with a 'year' column (pandas.dataframe)
+        rows -- new rows of the year (pandas.dataframe)
+        year -- year to replace (int)
+    returns:
+        updated dataframe (pandas.dataframe)
+    '''
+    kept = df[df['year'] != year]
+    if rows.empty:
+        return kept
+    rows = rows.reindex(columns=df.columns)
+    for col in df.columns:
+        try:
+            rows[col] = rows[col].astype(df[col].dtype)
+        except (TypeError, ValueError):
+            pass
+    return pd.concat([kept, rows])
+
+def cycle_poll(years, relDir='Datasets'):
+    '''National poll of the given years, read from their poll files only (see pollFunctions.poll_table()).
+    arguments:
+        years -- election years (list of ints)
+        relDir -- folder holding the poll files (str)
+    returns:
+        national poll indexed by year (pandas.series)
+    '''
+    return pfunc.national_poll(pfunc.poll_table(pfunc.load_polls(sorted(set(years)), relDir)))
+
+def cycle_rows(year, winners, winners2, base=None, lags=(2,), poll=None):
+    '''Rows of one election with all the features of houseFunctions.fetch_trimmed_data(), computed from the
+    results of that election and of the elections its lags look back to.
+    arguments:
+        year -- election year (int)
+        winners -- winner of every race, at least of year and of the lagged years (pandas.dataframe)
+        winners2 -- runner-up of every race (pandas.dataframe)
+        base -- dataset the rows are added to. fetch_trimmed_data() only keeps districts that exist in every
+                election of a dataset; a district is kept here if its row of the previous election is in base.
+                None only asks for the previous election (pandas.dataframe)
+        lags -- years to look back for the lag features (tuple of ints)
+        poll -- national poll, see houseFunctions.poll_lookup(). None reads the poll files of the years involved
+    returns:
+        rows of the election, indexed ST_DD_YYYY (pandas.dataframe)
+    '''
+    years = [year] + [year - lag for lag in lags]
+    if poll is None:
+        poll = cycle_poll(years)
+    rows = hfunc.fetch_trimmed_data(winners[winners['year'].isin(years)], winners2[winners2['year'].isin(years)],
+                                    minYear=year, lags=lags, poll=poll)
+    rows = rows[rows['year'] == year]
+
+    if base is not None and (base['year'] == year - 2).any():
+        previous = hfunc.index_to_key(base.index[base['year'] == year - 2])
+        rows = rows[np.isin(hfunc.previous_key(hfunc.index_to_key(rows.index)), previous)]
+    return rows
+
+def fill_columns(rows, dataset, columns, extra=None):
+    '''Fill the columns a derived dataset adds to the base dataset (e.g. demographics) for the rows of one year.
+    Values come from the rows already in the dataset, then from extra, then from the same district in the
+    previous election (the way ACS_Demographics_Processing.ipynb fills 2018 with the 2017 survey).
+    arguments:
+        rows -- rows of the year, indexed ST_DD_YYYY (pandas.dataframe)
+        dataset -- derived dataset (pandas.dataframe)
+        columns -- columns to fill (list)
+        extra -- values of the year's districts, indexed ST_DD_YYYY (pandas.dataframe)
+    returns:
+        rows with the columns (pandas.dataframe)
+    '''
+    source = dataset.loc[~dataset.index.duplicated(keep='first'), columns]
+    values = source.reindex(rows.index)
+    if extra is not None:
+        values = values.fillna(extra.reindex(index=rows.index, columns=columns))
+    previous = hfunc.key_to_index(hfunc.previous_key(hfunc.index_to_key(rows.index)))
+    values = values.fillna(source.reindex(previous).set_axis(rows.index, axis=0))
+    return rows.join(values)
+
+def save_dataset(dataset, relFilePath):
+    '''Write a dataset back to its pickle, and to its csv and feature store where those were made.
+    arguments:
+        dataset -- dataset (pandas.dataframe)
+        relFilePath -- path to the pickled dataset (str)
+    '''
+    pickle.dump(dataset, open(relFilePath, 'wb'))
+    csvPath = relFilePath[:-2] + '.csv'
+    if os.path.exists(csvPath):
+        dataset.to_csv(csvPath)
+    storePath = fstore.store_path(relFilePath)
+    if os.path.exists(os.path.join(storePath, fstore.MANIFEST)):
+        fstore.write_store(dataset, storePath, overwrite=True, sourcePath=relFilePath)
+
+def update_master_index(rows, year, relFilePath='Datasets/master_index.p'):
+    '''Replace the districts of one year in the master index of houseFunctions.fetch_index().
+    arguments:
+        rows -- races of the year, with the columns 'district', 'state' and 'year' (pandas.dataframe)
+        year -- election year (int)
+        relFilePath -- path to the master index pickle (str)
+    returns:
+        master index keyed by integer keys (pandas.dataframe)
+    '''
+    master_index = hfunc.fetch_index(None, None, load=True, string_index=False, relFilePath=relFilePath)
+    rows = rows[['district', 'state', 'year']].set_axis(pd.Index(hfunc.frame_key(rows), name='key'), axis=0)
+    master_index = replace_year(master_index, rows, year)
+    hfunc.save_index(master_index, relFilePath)
+    return master_index
+
+def ingest_cycle(year, results, runners_up=None, lags=(2,), poll=None, extra=None, base=BASE_DATASET,
+                 datasets=DERIVED_DATASETS, overlapPath='Datasets/all_overlap_data.p', resultsPath=RESULTS_PATH,
+                 indexPath='Datasets/master_index.p', save=True):
+    '''Add (or recount) one election cycle: store its results, then update the master index, the base dataset and
+    every derived dataset by replacing the rows of that year only.
+    arguments:
+        year -- election year (int)
+        results -- winners of the year's races, cleaned like clean_index() or read by read_wiki_results()
+                   (pandas.dataframe)
+        runners_up -- runners-up of the year's races, None uses the winners (the convention for races with a
+                      single candidate, and all that the wikipedia tables give) (pandas.dataframe)
+        lags -- years to look back for the lag features (tuple of ints)
+        poll -- national poll, see cycle_rows()
+        extra -- columns of derived datasets for the year's districts (e.g. demographics), indexed ST_DD_YYYY,
+                 see fill_columns() (pandas.dataframe)
+        base -- path to the dataset made by fetch_trimmed_data() (str)
+        datasets -- paths to the datasets derived from it (list of str). A dataset with centroid columns is a
+                    *_REDISTRICTDROP variant and drops the year's redistricted districts, so the year has to be
+                    in the overlap data first (the overlap stage of pipelineFunctions or
+                    overlapFunctions.overlap_data()), a ValueError is raised otherwise.
+        overlapPath -- path to the overlap data of redistrictingFunctions (str)
+        resultsPath -- path of the results pickle, see save_results() (str)
+        indexPath -- path to the master index pickle (str)
+        save -- write everything back to disk (bool)
+    returns:
+        updated datasets keyed by path, the base dataset included (dict of pandas.dataframe)
+    '''
+    winners, winners2 = load_results(resultsPath)
+    results = results[RESULT_COLS]
+    winners = replace_year(winners, results, year)
+    winners2 = replace_year(winners2, results if runners_up is None else runners_up[RESULT_COLS], year)
+
+    base_df = pickle.load(open(base, 'rb'))
+    rows = cycle_rows(year, winners, winners2, base=base_df, lags=lags, poll=poll)
+    updated = {base: replace_year(base_df, rows, year)}
+
+    overlap = None
+    for relFilePath in datasets:
+        dataset = pickle.load(open(relFilePath, 'rb'))
+        if year < dataset['year'].min():
+            continue
+        new_rows = rows
+        if all(col in dataset.columns for col in CENTROID_COLS):
+            if overlap is None:
+                overlap = pickle.load(open(overlapPath, 'rb'))
+                if not (overlap['year'] == year).any():
+                    raise ValueError('{} has no district overlaps of {}, so the redistricted districts of {} cannot '
+                                     'be dropped. Add {} to the overlap data first (overlapFunctions.overlap_data() '
+                                     'or the overlap stage of pipelineFunctions)'.format(
+                                         overlapPath, year, relFilePath, year))
+            new_rows = rfunc.redistrict_drop(new_rows, overlap)
+        added = [col for col in dataset.columns if col not in new_rows.columns]
+        new_rows = fill_columns(new_rows, dataset, added, extra=extra)
+        #datasets sorted by district (outer joins) stay sorted, the others get the year appended
+        is_sorted = dataset.index.is_monotonic_increasing
+        dataset = replace_year(dataset, new_rows, year)
+        updated[relFilePath] = dataset.sort_index() if is_sorted else dataset
+
+    if save:
+        save_results(winners, winners2, resultsPath)
+        update_master_index(results, year, indexPath)
+        for relFilePath, dataset in updated.items():
+            save_dataset(dataset, relFilePath)
+    return updated
@@ -0,0 +1,351 @@
+import os
+import json
+import pickle
+import hashlib
+import inspect
+import tempfile
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from sklearn.base import clone
+from sklearn.metrics import accuracy_score, log_loss, r2_score
+from functions import featureStore as fstore
+'''
+Model evaluation harness for model_submit.ipynb.
+
+Each (dataset, feature set) pair is loaded and split once, its arrays are written to .npy files that every worker
+memory maps read-only. The grid of (model x feature set x dataset x upsample) fits runs in a process pool and every
+fit is memoized by a hash of its configuration, in memory and on disk, along with its predictions, so plotting and
+scoring read the cached predictions instead of refitting.
+'''
+
+CACHE_DIR = 'Datasets/model_cache'
+SHARED_ARRAYS = ('X_train', 'y_train', 'X_test', 'y_test', 'flip_train')
+
+_memo = {}    # config hash -> result, for this process
+_shared = {}  # folder -> memory mapped split arrays, for each worker
+
+def load_split(filename, x_cols, y_col, state_hot_encoder=False, test_year=2018):
+    '''Load a dataset once and split it into training data (every year but test_year) and test data (test_year).
+    arguments:
+        filename -- path to the pickled dataset, read through its feature store if one was built (str)
+        x_cols -- predictors (list)
+        y_col -- column to predict, a single name or a list with one column (str or list)
+        state_hot_encoder -- add one hot encoded states to the predictors, first state dropped (bool)
+        test_year -- year held out for testing (int)
+    returns:
+        dictionary with the dataframes 'X_train', 'y_train', 'X_test', 'y_test' and the series 'flip_train',
+        'flip_test' (1 where the district changed party since the previous election) (dict)
+    '''
+    #list('dem_win') would split a single name into its characters
+    y_col = [y_col] if isinstance(y_col, str) else list(y_col)
+    x_cols = list(x_cols)
+    needed_cols = list(dict.fromkeys(x_cols + y_col + ['year', 'state', 'dem_win', 'dem_win_prev']))
+    full_dataset = fstore.load_frame(filename, columns=needed_cols)
+
+    X = full_dataset[x_cols]
+    if state_hot_encoder:
+        #encoding train and test together keeps the same state columns in both
+        X = pd.get_dummies(X.assign(state=full_dataset['state'].astype(str)), prefix='state', columns=['state'],
+                           drop_first=True, dtype=float)
+    flip = np.abs(full_dataset['dem_win'] - full_dataset['dem_win_prev'])
+    train = (full_dataset['year'] != test_year).values
+    return {'X_train': X[train], 'y_train': full_dataset.loc[train, y_col], 'flip_train': flip[train],
+            'X_test': X[~train], 'y_test': full_dataset.loc[~train, y_col], 'flip_test': flip[~train]}
+
+def model_config(model):
+    '''Configuration of an estimator: class and parameters. n_jobs is left out as it does not change the fit.
+    arguments:
+        model -- sklearn estimator
+    returns:
+        configuration (dict)
+    '''
+    params = model.get_params(deep=True)
+    params = {name: repr(value) for name, value in sorted(params.items())
+              if name != 'n_jobs' and not name.endswith('__n_jobs')}
+    return {'class': '{}.{}'.format(type(model).__module__, type(model).__name__), 'params': params}
+
+def config_hash(config):
+    '''Stable hash of a fit configuration.
+    arguments:
+        config -- json serializable configuration (dict)
+    returns:
+        hex digest (str)
+    '''
+    return hashlib.sha256(json.dumps(config, sort_keys=True, default=str).encode()).hexdigest()[:20]
+
+def share_split(split, folder):
+    '''Write the arrays workers need to .npy files.
+    arguments:
+        split -- output of load_split() (dict)
+        folder -- directory to write to (str)
+    '''
+    os.makedirs(folder, exist_ok=True)
+    for name in SHARED_ARRAYS:
+        values = np.asarray(split[name], dtype=float)
+        np.save(os.path.join(folder, name + '.npy'), values.ravel() if values.ndim > 1 and values.shape[1] == 1
+                else values, allow_pickle=False)
+
+def shared_split(folder):
+    '''Memory map the arrays written by share_split(), once per process.
+    arguments:
+        folder -- directory the arrays were written to (str)
+    returns:
+        read-only arrays keyed by name (dict)
+    '''
+    if folder not in _shared:
+        _shared[folder] = {name: np.load(os.path.join(folder, name + '.npy'), mmap_mode='r', allow_pickle=False)
+                           for name in SHARED_ARRAYS}
+    return _shared[folder]
+
+def upsample_indices(flip, seed=None, monsterframe=False):
+    '''Bootstrap the party flips until there are as many flips as non flips, as row positions instead of a copy.
+    arguments:
+        flip -- 1 where the district flipped (array-like)
+        seed -- random seed (int or numpy.random.RandomState)
+        monsterframe -- then draw 5 times as many rows again from the balanced rows (bool)
+    returns:
+        row positions: every row once followed by the bootstrapped flips (numpy.array of ints)
+    '''
+    rng = seed if isinstance(seed, np.random.RandomState) else np.random.RandomState(seed)
+    flip = np.asarray(flip)
+    flips = np.flatnonzero(flip == 1)
+    #we want to match the counts, so we need target number of bootstrapped samples
+    target = max(len(flip) - 2*len(flips), 0) if len(flips) else 0
+    rows = np.r_[np.arange(len(flip)), rng.choice(flips, size=target, replace=True)].astype(np.intp)
+    if monsterframe:
+        rows = np.r_[rows, rows[rng.randint(0, len(rows), size=5*len(rows))]]
+    return rows
+
+def upsample_weights(flip, seed=None, monsterframe=False):
+    '''Same bootstrap as upsample_indices() as a sample weight per row: how many times each row was drawn.
+    arguments:
+        flip -- 1 where the district flipped (array-like)
+        seed -- random seed (int or numpy.random.RandomState)
+        monsterframe -- see upsample_indices() (bool)
+    returns:
+        sample weights (numpy.array of floats)
+    '''
+    return np.bincount(upsample_indices(flip, seed, monsterframe), minlength=len(flip)).astype(float)
+
+def bootstrap_replicates(flip, n_replicates, seed=None, balance=True, weights=False):
+    '''Generate bootstrap replicates of the training rows, one at a time, for bagging and uncertainty estimates.
+    Memory does not grow with the number of replicates.
+    arguments:
+        flip -- 1 where the district flipped (array-like)
+        n_replicates -- number of replicates (int)
+        seed -- random seed, the same seed gives the same replicates (int)
+        balance -- upsample the flips of every replicate, see upsample_indices() (bool)
+        weights -- yield sample weights instead of row positions (bool)
+    yields:
+        row positions (numpy.array of ints) or sample weights (numpy.array of floats) of one replicate
+    '''
+    flip = np.asarray(flip)
+    for child in np.random.SeedSequence(seed).spawn(n_replicates):
+        rng = np.random.RandomState(np.random.MT19937(child))
+        rows = rng.randint(0, len(flip), size=len(flip))
+        if balance:
+            rows = rows[upsample_indices(flip[rows], rng)]
+        yield np.bincount(rows, minlength=len(flip)).astype(float) if weights else rows
+
+def accepts_sample_weight(model):
+    '''Whether an estimator's fit takes a sample_weight.
+    arguments:
+        model -- sklearn estimator
+    returns:
+        bool
+    '''
+    return 'sample_weight' in inspect.signature(model.fit).parameters
+
+def fit_resampled(model, X, y, rows):
+    '''Fit a clone of model on the rows of a resample: through sample_weight when the estimator takes one,
+    without copying X, otherwise on a copy of the selected rows.
+    arguments:
+        model -- unfitted sklearn estimator
+        X -- predictors (numpy.array)
+        y -- target (numpy.array)
+        rows -- row positions of the resample (numpy.array of ints)
+    returns:
+        fitted estimator
+    '''
+    model = clone(model)
+    if accepts_sample_weight(model):
+        #rows left out of the resample get weight 0, X is used as is
+        return model.fit(X, y, sample_weight=np.bincount(rows, minlength=len(y)).astype(float))
+    return model.fit(X[rows], y[rows])
+
+def fit_predict(folder, model, upsample=False, seed=209):
+    '''Fit one model on a shared split and predict the training and test data.
+    arguments:
+        folder -- directory of the shared split (str)
+        model -- unfitted sklearn estimator
+        upsample -- bootstrap the party flips of the training data, see upsample_indices() and fit_resampled() (bool)
+        seed -- random seed of the bootstrap (int)
+    returns:
+        dictionary with the fitted 'model', class predictions 'pred_train', 'pred_test' and probabilities
+        'prob_train', 'prob_test' (None if the model has no predict_proba) (dict)
+    '''
+    split = shared_split(folder)
+    X_train, y_train = split['X_train'], split['y_train']
+    if upsample:
+        model = fit_resampled(model, X_train, y_train, upsample_indices(split['flip_train'], seed))
+    else:
+        model = clone(model).fit(X_train, y_train)
+
+    result = {'model': model, 'pred_train': model.predict(X_train), 'pred_test': model.predict(split['X_test']),
+              'prob_train': None, 'prob_test': None}
+    if hasattr(model, 'predict_proba'):
+        result['prob_train'] = model.predict_proba(X_train)
+        result['prob_test'] = model.predict_proba(split['X_test'])
+    return result
+
+def bootstrap_predict(model, split, n_replicates=100, seed=209, balance=True):
+    '''Mean and spread of the test probabilities of a model over bootstrap replicates of the training data.
+    Replicates are fitted one after the other and only running sums are kept.
+    arguments:
+        model -- unfitted sklearn estimator with predict_proba
+        split -- output of load_split() (dict)
+        n_replicates -- number of bootstrap fits (int)
+        seed -- random seed of the replicates (int)
+        balance -- upsample the flips of every replicate (bool)
+    returns:
+        mean probability of the positive class for every test row (numpy.array)
+        standard deviation of that probability over the replicates (numpy.array)
+    '''
+    X_train = np.asarray(split['X_train'], dtype=float)
+    y_train = np.asarray(split['y_train']).ravel()
+    X_test = np.asarray(split['X_test'], dtype=float)
+    total = np.zeros(len(X_test))
+    total_sq = np.zeros(len(X_test))
+    for rows in bootstrap_replicates(np.asarray(split['flip_train']), n_replicates, seed, balance):
+        prob = fit_resampled(model, X_train, y_train, rows).predict_proba(X_test)[:, 1]
+        total += prob
+        total_sq += prob**2
+    mean = total/n_replicates
+    return mean, np.sqrt(np.clip(total_sq/n_replicates - mean**2, 0, None))
+
+def _fit_task(task):
+    folder, model, upsample, seed = task
+    return fit_predict(folder, model, upsample, seed)
+
+def evaluate_grid(datasets, feature_sets, model_dict, y_col=('dem_win',), upsample=(False,), state_hot_encoder=False,
+                  seed=209, n_jobs=None, cacheDir=CACHE_DIR):
+    '''Fit and predict every (dataset x feature set x model x upsample) configuration.
+    Configurations fitted before are read from the cache, the others run in a process pool.
+    arguments:
+        datasets -- paths to the pickled datasets (list)
+        feature_sets -- predictors to try, keyed by a name (dict of lists), or a single list of predictors
+        model_dict -- unfitted sklearn estimators keyed by model name (dict)
+        y_col -- column to predict (list with one column)
+        upsample -- upsample flags to try (list of bools)
+        state_hot_encoder -- see load_split() (bool)
+        seed -- random seed of the bootstraps (int)
+        n_jobs -- number of worker processes, 1 runs in this process, None uses every core (int)
+        cacheDir -- directory to keep fitted models and predictions in, None keeps them in memory only (str)
+    returns:
+        results keyed by (dataset, feature set name, model name, upsample), see fit_predict() (dict)
+        splits keyed by (dataset, feature set name), see load_split() (dict)
+    '''
+    if not isinstance(feature_sets, dict):
+        feature_sets = {'features': list(feature_sets)}
+    if cacheDir is not None:
+        os.makedirs(cacheDir, exist_ok=True)
+
+    splits, tasks, results = {}, {}, {}
+    for dataset in datasets:
+        #hash what load_split() reads: the feature store when one was built, the pickle otherwise
+        data_hash = fstore.source_hash(dataset)
+        for set_name, x_cols in feature_sets.items():
+            splits[(dataset, set_name)] = load_split(dataset, x_cols, y_col, state_hot_encoder)
+            for model_name, model in model_dict.items():
+                for flag in upsample:
+                    key = (dataset, set_name, model_name, flag)
+                    config = {'data': data_hash, 'x_cols': list(x_cols), 'y_col': list(y_col), 'upsample': bool(flag),
+                              'state_hot_encoder': bool(state_hot_encoder), 'seed': seed, 'model': model_config(model),
+                              'resample': 'weight' if flag and accepts_sample_weight(model) else 'index'}
+                    digest = config_hash(config)
+                    cached = _memo.get(digest)
+                    cachePath = None if cacheDir is None else os.path.join(cacheDir, digest + '.p')
+                    if cached is None and cachePath is not None and os.path.exists(cachePath):
+                        cached = _memo[digest] = pickle.load(open(cachePath, 'rb'))
+                    if cached is None:
+                        tasks[key] = (digest, cachePath, model, flag)
+                    else:
+                        results[key] = cached
+
+    with tempfile.TemporaryDirectory() as tmpDir:
+        folders = {}
+        for dataset, set_name, _, _ in tasks:
+            if (dataset, set_name) not in folders:
+                folders[(dataset, set_name)] = os.path.join(tmpDir, str(len(folders)))
+                share_split(splits[(dataset, set_name)], folders[(dataset, set_name)])
+
+        keys = list(tasks)
+        jobs = []
+        for key in keys:
+            model = clone(tasks[key][2])
+            #the pool supplies the parallelism, keep each fit on one core
+            if n_jobs != 1 and 'n_jobs' in model.get_params():
+                model.set_params(n_jobs=1)
+            jobs.append((folders[key[:2]], model, tasks[key][3], seed))
+        if n_jobs == 1 or len(jobs) <= 1:
+            fitted = [_fit_task(job) for job in jobs]
+        else:
+            with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+                fitted = list(pool.map(_fit_task, jobs))
+        _shared.clear()
+
+    for key, result in zip(keys, fitted):
+        digest, cachePath = tasks[key][:2]
+        result['hash'] = digest
+        _memo[digest] = results[key] = result
+        if cachePath is not None:
+            pickle.dump(result, open(cachePath, 'wb'))
+    return results, splits
+
+def model_scores(result, split, score='accuracy_score'):
+    '''Train, test, non flip and flip scores of a fit, from its cached predictions.
+    arguments:
+        result -- one result of evaluate_grid() (dict)
+        split -- the split it was fitted on, see load_split() (dict)
+        score -- 'accuracy_score', 'log_loss' or 'r2_score' (str)
+    returns:
+        scores keyed 'train', 'test', 'noflip', 'flip' (dict)
+    '''
+    y_train = np.asarray(split['y_train']).ravel()
+    y_test = np.asarray(split['y_test']).ravel()
+    flip_mask_test = np.asarray(split['flip_test']) == 1
+    if score == 'accuracy_score':
+        metric, pred_train, pred_test = accuracy_score, result['pred_train'].round(), result['pred_test'].round()
+    elif score == 'log_loss':
+        metric, pred_train, pred_test = log_loss, result['prob_train'], result['prob_test']
+    elif score == 'r2_score':
+        metric, pred_train, pred_test = r2_score, result['prob_train'][:, 1], result['prob_test'][:, 1]
+    else:
+        raise ValueError('unknown score {!r}'.format(score))
+
+    def safe(y, pred):
+        try:
+            return metric(y, pred, labels=[0, 1]) if metric is log_loss else metric(y, pred)
+        except ValueError:
+            return np.nan
+    return {'train': safe(y_train, pred_train), 'test': safe(y_test, pred_test),
+            'noflip': safe(y_test[~flip_mask_test], pred_test[~flip_mask_test]),
+            'flip': safe(y_test[flip_mask_test], pred_test[flip_mask_test])}
+
+def score_table(results, splits, score='accuracy_score'):
+    '''Scores of every fit of evaluate_grid() in one long table.
+    arguments:
+        results -- results of evaluate_grid() (dict)
+        splits -- splits of evaluate_grid() (dict)
+        score -- see model_scores() (str)
+    returns:
+        dataframe with the columns 'dataset', 'features', 'model_name', 'upsample', 'subset' and 'metric'
+        (pandas.dataframe)
+    '''
+    rows = []
+    for (dataset, set_name, model_name, flag), result in results.items():
+        for subset, metric in model_scores(result, splits[(dataset, set_name)], score).items():
+            rows.append({'dataset': dataset, 'features': set_name, 'model_name': model_name, 'upsample': flag,
+                         'subset': subset, 'metric': metric})
+    return pd.DataFrame(rows, columns=['dataset', 'features', 'model_name', 'upsample', 'subset', 'metric'])
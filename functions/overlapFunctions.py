@@ -0,0 +1,367 @@
+import os
+import numpy as np
+import pandas as pd
+import shapely
+from concurrent.futures import ProcessPoolExecutor
+from functions import houseFunctions as hfunc
+'''
+Overlap between this year's and the previous election's congressional districts.
+
+Replaces the all-pairs loops of district_shapefiles/overlap_area.ipynb: every polygon is validated/repaired once,
+candidate pairs come from an STRtree query instead of comparing every district with every district of its state,
+pairs where one district contains the other skip the intersection, and year pairs run in a process pool.
+
+district_df -- dataframe indexed ST_DD_YYYY with the columns 'state', 'year' and 'shape' (shapely polygons),
+               as made by read_shapefiles()
+'''
+
+#translate between the naming conventions of the shapefiles, state names and fips codes are hfunc.state_names
+#and hfunc.state_fips
+ELECTION_YEARS = np.array([1992, 1994, 1996, 1998, 2000, 2002, 2004, 2006, 2008, 2010, 2012, 2014, 2016, 2018])
+CONGRESS_IDS = np.array([103, 104, 105, 106, 107, 108, 109, 110, 111, 112, 113, 114, 115, 116])
+
+def shapefile_path(election_year, shapeDir='district_shapefiles'):
+    '''Path of the district shapefile of an election, UCLA files (http://cdmaps.polisci.ucla.edu/) before 2016
+    and US Census TIGER/Line files (https://www.census.gov/geo/maps-data/data/cbf/cbf_cds.html) from 2016 on.
+    arguments:
+        election_year -- even election year (int)
+        shapeDir -- folder holding the districtShapes-NNN and tl_YYYY_us_cdNNN folders (str)
+    returns:
+        path to the .shp file (str)
+    '''
+    congress_id = CONGRESS_IDS[ELECTION_YEARS == election_year][0]
+    if election_year < 2016:
+        return os.path.join(shapeDir, 'districtShapes-{0}'.format(congress_id), 'districts{0}.shp'.format(congress_id))
+    return os.path.join(shapeDir, 'tl_{1}_us_cd{0}'.format(congress_id, election_year),
+                        'tl_{1}_us_cd{0}.shp'.format(congress_id, election_year))
+
+def read_shapefiles(election_years, shapeDir='district_shapefiles', indexPath='Datasets/master_index.p'):
+    '''Read the district shapes of some elections onto the master index, as read_shapefiles() of overlap_area.ipynb.
+    Districts outside the 50 states and TIGER/Line 'ZZ' areas are skipped, at-large districts are numbered 1.
+    Needs cartopy.
+    arguments:
+        election_years -- even election years to read (list of ints)
+        shapeDir -- see shapefile_path() (str)
+        indexPath -- path to the master index pickle (str)
+    returns:
+        master index with the legacy ST_DD_YYYY index and the shapes stored in a column named 'shape', nan where
+        a district has no shape (pandas.dataframe)
+    '''
+    import cartopy.io.shapereader as shpreader
+
+    district_df = hfunc.fetch_index(None, None, load=True, string_index=True, relFilePath=indexPath)
+    name_to_abbr = dict(zip(hfunc.state_names, hfunc.state_abbrs))
+    fips_to_abbr = dict(zip(hfunc.state_fips, hfunc.state_abbrs))
+    shapes = {}
+    for election_year in election_years:
+        congress_id = CONGRESS_IDS[ELECTION_YEARS == election_year][0]
+        for record in shpreader.Reader(shapefile_path(election_year, shapeDir)).records():
+            attr = record.attributes
+            if election_year < 2016:
+                state = name_to_abbr.get(attr['STATENAME'].upper())
+                district = attr['DISTRICT']
+            else:
+                state = fips_to_abbr.get(int(attr['STATEFP']))
+                district = attr['CD{}FP'.format(congress_id)]
+            if state in (None, 'DC') or district == 'ZZ': # pretty much just Washington, DC
+                continue
+            shapes['{}_{:02d}_{}'.format(state, max(int(district), 1), election_year)] = record.geometry
+
+    district_df['shape'] = pd.Series(shapes, dtype=object).reindex(district_df.index)
+    return district_df
+
+def district_centroids(district_df):
+    '''Centroid of every district in lon, lat, ignoring spherical geometry.
+    arguments:
+        district_df -- dataframe with shapefiles stored in a column named 'shape' (pandas.dataframe)
+    returns:
+        centroids as shapely points, None where there is no shape (pandas.series)
+    '''
+    shapes = repair_shapes(district_df['shape'].values)
+    return pd.Series(shapely.centroid(shapes), index=district_df.index, name='centroid', dtype=object)
+
+def repair_shapes(shapes):
+    '''Validate every polygon once, self-intersecting polygons are repaired with buffer(0).
+    arguments:
+        shapes -- polygons, missing shapes may be nan or None (array-like)
+    returns:
+        repaired polygons, None where there is no shape (numpy.array of shapely geometries)
+    '''
+    shapes = np.array([shape if isinstance(shape, shapely.Geometry) else None for shape in shapes], dtype=object)
+    invalid = ~shapely.is_valid(shapes) & ~shapely.is_missing(shapes)
+    if invalid.any():
+        shapes[invalid] = shapely.buffer(shapes[invalid], 0)
+    return shapes
+
+def overlap_pairs(shapes, states, shapes_prev, states_prev):
+    '''Area of overlap between every pair of in-state districts that intersect.
+    arguments:
+        shapes -- repaired polygons of this year's districts (numpy.array)
+        states -- state of each of this year's districts (numpy.array)
+        shapes_prev -- repaired polygons of the previous year's districts (numpy.array)
+        states_prev -- state of each of the previous year's districts (numpy.array)
+    returns:
+        positions into shapes of every pair (numpy.array of ints)
+        positions into shapes_prev of every pair (numpy.array of ints)
+        area of this year's district of every pair (numpy.array of floats)
+        area of the previous district of every pair (numpy.array of floats)
+        area of overlap of every pair (numpy.array of floats)
+    '''
+    #candidate pairs from the bounding box tree, refined to real intersections
+    tree = shapely.STRtree(shapes_prev)
+    shapely.prepare(shapes)
+    shapely.prepare(shapes_prev)
+    ind, ind_prev = tree.query(shapes, predicate='intersects')
+
+    #districts are only ever compared with districts of their own state
+    same_state = np.asarray(states)[ind] == np.asarray(states_prev)[ind_prev]
+    ind, ind_prev = ind[same_state], ind_prev[same_state]
+    order = np.lexsort((ind_prev, ind))
+    ind, ind_prev = ind[order], ind_prev[order]
+
+    #containment shortcut: an unchanged district covers its old self, no intersection needed
+    area = shapely.area(shapes)[ind]
+    area_prev = shapely.area(shapes_prev)[ind_prev]
+    inside_prev = shapely.contains(shapes_prev[ind_prev], shapes[ind])
+    covers_prev = ~inside_prev & shapely.contains(shapes[ind], shapes_prev[ind_prev])
+    overlap_area = np.where(inside_prev, area, area_prev)
+    rest = ~inside_prev & ~covers_prev
+    overlap_area[rest] = shapely.area(shapely.intersection(shapes[ind[rest]], shapes_prev[ind_prev[rest]]))
+    return ind, ind_prev, area, area_prev, overlap_area
+
+def year_overlap(this_year, district_df, repair=True):
+    '''Overlap pairs between this_year's districts and the previous election's districts.
+    arguments:
+        this_year -- (int) Elections years of the districts you want to check. Even years only.
+        district_df -- (pd dataframe) dataframe with shapefiles stored in a column named 'shape'
+        repair -- (bool) validate and repair the shapes first, skip if they were repaired already
+    returns:
+        dataframe with one row per overlapping in-state pair: index and area of this year's district ('ind', 'area'),
+        index and area of the previous district ('ind_prev', 'area_prev') and the area of overlap ('overlap_area')
+    '''
+    prev_year = this_year-2
+    has_shape = district_df['shape'].map(lambda shape: isinstance(shape, shapely.Geometry))
+    districts = district_df[(district_df['year'] == this_year) & has_shape]
+    districts_prev = district_df[(district_df['year'] == prev_year) & has_shape]
+
+    shapes = districts['shape'].values
+    shapes_prev = districts_prev['shape'].values
+    if repair:
+        shapes, shapes_prev = repair_shapes(shapes), repair_shapes(shapes_prev)
+    ind, ind_prev, area, area_prev, overlap_area = overlap_pairs(shapes, districts['state'].values,
+                                                                 shapes_prev, districts_prev['state'].values)
+    return pd.DataFrame({'ind': districts.index.values[ind], 'ind_prev': districts_prev.index.values[ind_prev],
+                         'area': area, 'area_prev': area_prev, 'overlap_area': overlap_area})
+
+def group_dicts(keys, inner_keys, values):
+    '''Build one {inner_key: value} dictionary per key, keys and entries in the order given.
+    arguments:
+        keys -- outer keys, equal keys must be adjacent (array-like)
+        inner_keys -- dictionary keys (array-like)
+        values -- dictionary values (array-like)
+    returns:
+        dictionaries, keyed by outer key (dict)
+    '''
+    dicts = {}
+    for key, inner_key, value in zip(keys, inner_keys, values):
+        dicts.setdefault(key, {})[inner_key] = value
+    return dicts
+
+def group_sums(groups, values):
+    '''Sum of the values of each group, repeated for every value of the group.
+    arguments:
+        groups -- group of each value, equal groups must be adjacent (numpy.array)
+        values -- values to add up (numpy.array of floats)
+    returns:
+        sum of each value's group (numpy.array of floats)
+    '''
+    if len(values) == 0:
+        return values
+    starts = np.flatnonzero(np.r_[True, groups[1:] != groups[:-1]])
+    sums = np.add.reduceat(values, starts)
+    return np.repeat(sums, np.diff(np.r_[starts, len(values)]))
+
+def area_weights(pairs):
+    '''Fraction of each of this year's districts that lies in each previous district, rounded to the thousandth.
+    Overlaps under 0.1% are dropped and districts whose fractions don't add up to 1 are rescaled.
+    arguments:
+        pairs -- output of year_overlap() (pandas.dataframe)
+    returns:
+        this year's district of every weight (numpy.array)
+        previous district of every weight (numpy.array)
+        fractional overlap (numpy.array of floats)
+    '''
+    # fractional overlap between new and old district, round to the thousandth
+    # use threshold of 0.1% to avoid trivial changes
+    frac = np.around(pairs['overlap_area'].values/pairs['area'].values, decimals=3)
+    keep = frac > 10**-3
+    ind, ind_prev, frac = pairs['ind'].values[keep], pairs['ind_prev'].values[keep], frac[keep]
+
+    # make sure areas add up to 1, rescale the districts where they don't
+    dict_sum = group_sums(ind, frac)
+    rescale = ~np.isclose(dict_sum, 1., rtol=1e-03)
+    scaled = frac/np.where(rescale, dict_sum, 1.)
+    frac = np.where(rescale, np.around(scaled, decimals=3), frac)
+    keep = ~rescale | (scaled > 10**-3)
+    return ind[keep], ind_prev[keep], frac[keep]
+
+def population_weights(pairs, inverse=False):
+    '''Share of each of this year's districts' population coming from each previous district,
+    (overlap_area / area) * (1 / area_prev) rescaled to add up to 1 and rounded to the thousandth.
+    arguments:
+        pairs -- output of year_overlap() (pandas.dataframe)
+        inverse -- share of each previous district's population going to each of this year's districts instead (bool)
+    returns:
+        district the shares add up to 1 for (numpy.array)
+        district each share comes from (inverse: goes to) (numpy.array)
+        population overlap (numpy.array of floats)
+    '''
+    if inverse:
+        pairs = pairs.sort_values('ind_prev', kind='mergesort')
+        outer, inner = pairs['ind_prev'].values, pairs['ind'].values
+        frac_overlap = pairs['overlap_area'].values/pairs['area_prev'].values
+        density = 1./pairs['area'].values
+    else:
+        outer, inner = pairs['ind'].values, pairs['ind_prev'].values
+        frac_overlap = pairs['overlap_area'].values/pairs['area'].values
+        density = 1./pairs['area_prev'].values # assume population roughly the same, but area changes
+
+    # use threshold of 0.1% to avoid trivial changes, then rescale so they add up to 1.
+    keep = frac_overlap > 10**-3
+    outer, inner, overlap = outer[keep], inner[keep], frac_overlap[keep]*density[keep]
+    scaled = overlap/group_sums(outer, overlap)
+    keep = scaled > 10**-3
+    return outer[keep], inner[keep], np.around(scaled[keep], decimals=3)
+
+def district_overlap(this_year, district_df, threshold_for_change=0.1, pairs=None):
+    """
+    Finds the fractional overlap between this year's district and the previous year's districts.
+    Same output as district_overlap() in overlap_area.ipynb.
+
+    input:
+        this_year -- (int) Elections years of the districts you want to check. Even years only.
+        district_df -- (pd dataframe) dataframe with default indices and shapefiles stored in
+                       a column named 'shape'
+        threshold_for_change -- (float) fraction of a district's area that may move before it counts as changed
+        pairs -- (pd dataframe) output of year_overlap(), computed here if None
+    output:
+        district_df -- with the columns 'overlap_frac' ({previous district: fractional overlap}) and
+                       'border_change' (0 - unchanged, 1 - changed more than the threshold or new)
+    """
+    if pairs is None:
+        pairs = year_overlap(this_year, district_df)
+    prev_year = this_year-2
+
+    if 'overlap_frac' not in district_df.columns:
+        district_df['overlap_frac'] = [np.nan]*district_df.shape[0] # make a blank column
+        district_df['overlap_frac'] = district_df['overlap_frac'].astype(object) # reassign to object so it can hold dicts
+    if 'border_change' not in district_df.columns:
+        district_df['border_change'] = [np.nan]*district_df.shape[0] # make a blank column
+
+    overlap_dicts = group_dicts(*area_weights(pairs))
+
+    districts = district_df.index[(district_df['year'] == this_year) &
+                                  district_df['shape'].map(lambda shape: isinstance(shape, shapely.Geometry))]
+    overlap_dicts = [overlap_dicts.get(ind, {}) for ind in districts]
+    district_df.loc[districts, 'overlap_frac'] = pd.Series(overlap_dicts, index=districts, dtype=object)
+
+    # calculate the status of the new district
+    prev_index = set(district_df.index[district_df['year'] == prev_year])
+    border_change = []
+    for ind, overlap_dict in zip(districts, overlap_dicts):
+        ind_prev = '{}{}'.format(ind[:6], prev_year) # same district, different year
+        if ind_prev not in prev_index or ind_prev not in overlap_dict: # new or in a totally new location
+            border_change.append(1)
+        elif 1.-overlap_dict[ind_prev] > threshold_for_change: # the borders have moved
+            border_change.append(1)
+        else: # the district is essentially the same as last year
+            border_change.append(0)
+    district_df.loc[districts, 'border_change'] = border_change
+    return district_df
+
+def population_overlap(this_year, district_df, pairs=None, inverse=False):
+    """
+    Estimates percent of population coming from previous district boundaries,
+    population_overlap = (overlap_area / area) * (1 / area_prev), rescaled to add up to 1.
+    Same output as population_overlap() and inverse_population_overlap() in overlap_area.ipynb.
+
+    input:
+        this_year -- (int) Elections years of the districts you want to check. Even years only.
+        district_df -- (pd dataframe) dataframe with default indices and shapefiles stored in
+                       a column named 'shape'
+        pairs -- (pd dataframe) output of year_overlap(), computed here if None
+        inverse -- (bool) give each previous district a dictionary of this year's districts instead,
+                   stored in 'inverse_population_overlap'
+    output:
+        district_df -- with the column 'population_overlap' ({previous district: population overlap})
+                       or 'inverse_population_overlap' ({this year's district: population overlap})
+    """
+    if pairs is None:
+        pairs = year_overlap(this_year, district_df)
+    column = 'inverse_population_overlap' if inverse else 'population_overlap'
+    if column not in district_df.columns:
+        district_df[column] = [np.nan]*district_df.shape[0] # make a blank column
+        district_df[column] = district_df[column].astype(object) # reassign to object so it can hold dicts
+
+    year = this_year-2 if inverse else this_year
+    overlap_dicts = group_dicts(*population_weights(pairs, inverse=inverse))
+
+    districts = district_df.index[(district_df['year'] == year) &
+                                  district_df['shape'].map(lambda shape: isinstance(shape, shapely.Geometry))]
+    district_df.loc[districts, column] = pd.Series([overlap_dicts.get(ind, {}) for ind in districts],
+                                                   index=districts, dtype=object)
+    return district_df
+
+def build_overlap(district_df, years_to_check, threshold_for_change=0.1, n_jobs=None):
+    '''Area overlap, border change, population overlap and inverse population overlap for every year to check.
+    Intersections are computed once per year pair and shared by all outputs, year pairs run in a process pool.
+    arguments:
+        district_df -- dataframe with shapefiles stored in a column named 'shape', must hold every year to check
+                       and the election before it (pandas.dataframe)
+        years_to_check -- election years to compare with the election before them (list of ints)
+        threshold_for_change -- fraction of a district's area that may move before it counts as changed (float)
+        n_jobs -- number of worker processes, 1 runs in this process, None uses every core (int)
+    returns:
+        district_df with the columns 'overlap_frac', 'border_change', 'population_overlap' and
+        'inverse_population_overlap' (pandas.dataframe)
+    '''
+    district_df = district_df.copy()
+    district_df['shape'] = repair_shapes(district_df['shape'].values)
+
+    #ship each worker only the two years it needs
+    frames = [district_df.loc[district_df['year'].isin([year, year-2]), ['state', 'year', 'shape']]
+              for year in years_to_check]
+    if n_jobs == 1 or len(years_to_check) <= 1:
+        all_pairs = [year_overlap(year, frame, repair=False) for year, frame in zip(years_to_check, frames)]
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            all_pairs = list(pool.map(year_overlap, years_to_check, frames, [False]*len(frames)))
+
+    #inverse overlap of a year is stored on the previous year's rows, so go in year order
+    for year, pairs in sorted(zip(years_to_check, all_pairs), key=lambda item: item[0]):
+        district_df = district_overlap(year, district_df, threshold_for_change, pairs=pairs)
+        district_df = population_overlap(year, district_df, pairs=pairs)
+        district_df = population_overlap(year, district_df, pairs=pairs, inverse=True)
+    return district_df
+
+def overlap_data(years_to_check, shapeDir='district_shapefiles', indexPath='Datasets/master_index.p',
+                 threshold_for_change=0.1, n_jobs=None):
+    '''all_overlap_data.p of overlap_area.ipynb: overlap, border change, centroid and population overlap of every
+    district, from the shapefiles of the years to check and the election before each.
+    arguments:
+        years_to_check -- election years to compare with the election before them (list of ints)
+        shapeDir -- see shapefile_path() (str)
+        indexPath -- path to the master index pickle (str)
+        threshold_for_change -- see build_overlap() (float)
+        n_jobs -- see build_overlap() (int)
+    returns:
+        dataframe indexed ST_DD_YYYY with the columns 'district', 'state', 'year', 'overlap_frac', 'border_change',
+        'centroid', 'population_overlap' and 'inverse_population_overlap' (pandas.dataframe)
+    '''
+    years_to_read = sorted(set(years_to_check) | {year - 2 for year in years_to_check})
+    district_df = read_shapefiles(years_to_read, shapeDir, indexPath)
+    district_df = build_overlap(district_df, years_to_check, threshold_for_change, n_jobs)
+    district_df['centroid'] = district_centroids(district_df)
+    columns = ['district', 'state', 'year', 'overlap_frac', 'border_change', 'centroid', 'population_overlap',
+               'inverse_population_overlap']
+    return district_df[columns]
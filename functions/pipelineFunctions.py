@@ -0,0 +1,416 @@
+import os
+import json
+import time
+import shutil
+import pickle
+import hashlib
+import inspect
+import argparse
+import resource
+import importlib.util
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+import pandas as pd
+from functions import houseFunctions as hfunc
+from functions import pollFunctions as pfunc
+from functions import demographicsFunctions as dfunc
+from functions import overlapFunctions as ofunc
+from functions import redistrictingFunctions as rfunc
+from functions import ingestFunctions as ifunc
+from functions import featureStore as fstore
+'''
+The preprocessing notebooks as one pipeline of stages, run from the repository root:
+
+    python -m functions.pipelineFunctions [stage ...] [--force stage ...] [--jobs N] [--dry-run]
+
+    results         House-Preprocessing.ipynb     FEC and wikipedia results -> house_results.p, master_index.p
+    national_poll   ballot_processing.ipynb       generic ballot polls -> national_poll.p
+    trimmed_data    House-Preprocessing.ipynb     -> data_FEC_NATIONALPOLL_2004_2018
+    demographics    ACS_Demographics_Processing   ACS S0201 files -> DEMOGRAPHICS / DEMOGRAPHICSIMPUTED datasets
+    overlap         overlap_area.ipynb            district shapefiles -> all_overlap_data.p
+    redistricting   redistricting-corrections     -> *_REDISTRICTDROP datasets
+    models          model_submit.ipynb            -> model_scores.p
+
+A stage runs after the stages that write its inputs, independent stages (e.g. overlap next to national_poll,
+trimmed_data and demographics) run at the same time in a process pool. Every stage is keyed by a hash of its
+parameters, its code and its input files. The outputs of every key are kept in the cache, so a stage whose key was
+seen before is skipped, and its outputs are restored from the cache if they were deleted since. Outputs changed on
+disk after the cached run (e.g. a cycle added by ingestFunctions.ingest_cycle()) are kept as they are, --force runs
+the stage again. A stage whose inputs are missing (e.g. the shapefiles, which are not in the repository) keeps the
+outputs already on disk.
+Each stage runs in a fresh worker process, its wall time, peak resident memory and output rows are reported.
+'''
+
+CACHE_DIR = 'Datasets/pipeline_cache'
+MANIFEST = 'manifest.json'
+
+#name -- stage name (str)
+#func -- module level function(inputs, outputs, **params) writing the outputs, returns {label: rows} (function)
+#inputs, outputs -- file paths (lists of str)
+#params -- json serializable keyword arguments of func (dict)
+#modules -- names of the modules whose code the stage depends on besides func itself (list of str)
+Stage = namedtuple('Stage', ['name', 'func', 'inputs', 'outputs', 'params', 'modules'])
+
+POLL_YEARS = [2002, 2004, 2006, 2008, 2010, 2012, 2014, 2016, 2018]
+OVERLAP_YEARS = [2004, 2006, 2008, 2010, 2012, 2014, 2016, 2018]
+ACS_FILES = ['Datasets/demographics/ACS_{}_1YR_S0201_with_ann.csv'.format(year) for year in (10, 12, 14, 16, 17)]
+DEMOGRAPHICS = 'Datasets/data_FEC_NATIONALPOLL_DEMOGRAPHICS_2010_2018.p'
+DEMOGRAPHICS_IMPUTED = 'Datasets/data_FEC_NATIONALPOLL_DEMOGRAPHICSIMPUTED_2004_2018.p'
+OVERLAP_PATH = 'Datasets/all_overlap_data.p'
+SCORES_PATH = 'Datasets/model_scores.p'
+
+#the comparison of model_submit.ipynb
+MODEL_DATASETS = [DEMOGRAPHICS, DEMOGRAPHICS_IMPUTED, DEMOGRAPHICS_IMPUTED[:-2] + '_REDISTRICTDROP.p']
+FEATURE_SETS = {'polls+margin': ['national_poll', 'margin_signed_minus_prev'],
+                'polls+margin+age': ['national_poll', 'margin_signed_minus_prev', 'age18_24_pct', 'age25_34_pct'],
+                'polls+margin+demog': ['national_poll', 'margin_signed_minus_prev', 'female_pct',
+                                       'foreign_to_native_born_ratio', 'age18_24_pct', 'age25_34_pct']}
+
+def save_frame(frame, outputs):
+    '''Write a dataset to its pickle with ingestFunctions.save_dataset() and to the csv among the outputs.
+    arguments:
+        frame -- dataset (pandas.dataframe)
+        outputs -- the pickle path, optionally followed by the csv path (list of str)
+    '''
+    if len(outputs) > 1 and not os.path.exists(outputs[1]):
+        frame.to_csv(outputs[1]) # save_dataset() only refreshes a csv that exists
+    ifunc.save_dataset(frame, outputs[0])
+
+def results_stage(inputs, outputs, minYear=2002, wikiYear=2018):
+    '''Winners and runners-up of every race and the master index, as House-Preprocessing.ipynb.
+    inputs: FEC results csv, wikipedia results csv. outputs: results pickle, master index pickle.
+    '''
+    winners, winners2 = hfunc.load_data(inputs[0], minYear=minYear)
+    winners, winners2 = hfunc.clean_index(winners), hfunc.clean_index(winners2)
+    wiki = ifunc.read_wiki_results(inputs[1], wikiYear)
+    master_index = hfunc.fetch_index(winners, wiki, save=True, relFilePath=outputs[1])
+    winners = pd.concat([winners, wiki[ifunc.RESULT_COLS]])
+    winners2 = pd.concat([winners2, wiki[ifunc.RESULT_COLS]])
+    ifunc.save_results(winners, winners2, outputs[0])
+    return {'winners': len(winners), 'master_index': len(master_index)}
+
+def national_poll_stage(inputs, outputs, years=POLL_YEARS, window='legacy'):
+    '''National poll of every district, as format_national_polls() of ballot_processing.ipynb.
+    inputs: master index pickle, poll files. outputs: national poll pickle.
+    '''
+    table = pfunc.poll_table(pfunc.load_polls(years, os.path.dirname(inputs[1])),
+                             [None if window == 'legacy' else window])
+    poll_df = hfunc.fetch_index(None, None, load=True, string_index=True, relFilePath=inputs[0])
+    poll_df['national_poll'] = poll_df['year'].map(pfunc.national_poll(table, window))
+    pickle.dump(poll_df, open(outputs[0], 'wb'))
+    return {'national_poll': len(poll_df)}
+
+def trimmed_data_stage(inputs, outputs, minYear=2004):
+    '''Results and poll features of every race, as House-Preprocessing.ipynb.
+    inputs: results pickle, national poll pickle. outputs: dataset pickle and csv.
+    '''
+    winners, winners2 = ifunc.load_results(inputs[0])
+    data = hfunc.fetch_trimmed_data(winners, winners2, minYear=minYear, poll=pickle.load(open(inputs[1], 'rb')))
+    save_frame(data, outputs)
+    return {'data': len(data)}
+
+def demographics_stage(inputs, outputs, relabel=((2017, 2018),), impute_year=2010):
+    '''Datasets with the ACS demographics, as ACS_Demographics_Processing.ipynb.
+    inputs: dataset pickle, ACS files. outputs: pickle and csv of the dataset with demographics, then of the
+    imputed dataset.
+    '''
+    demographics = dfunc.acs_features(inputs[1:], relabel=dict(relabel))
+    fec = pickle.load(open(inputs[0], 'rb'))
+    joined = dfunc.join_demographics(fec, demographics)
+    imputed = dfunc.join_demographics(fec, demographics, impute_year=impute_year)
+    save_frame(joined, outputs[:2])
+    save_frame(imputed, outputs[2:])
+    return {'demographics': len(joined), 'imputed': len(imputed)}
+
+def overlap_stage(inputs, outputs, years_to_check=OVERLAP_YEARS, shapeDir='district_shapefiles',
+                  threshold_for_change=0.1):
+    '''Overlap data of the district shapes, as overlap_area.ipynb.
+    inputs: master index pickle, shapefiles. outputs: overlap pickle.
+    '''
+    overlap = ofunc.overlap_data(years_to_check, shapeDir, inputs[0], threshold_for_change)
+    pickle.dump(overlap, open(outputs[0], 'wb'))
+    return {'overlap': len(overlap)}
+
+def redistricting_stage(inputs, outputs, threshold_for_change=None):
+    '''*_REDISTRICTDROP variants of datasets, as redistricting-corrections.ipynb.
+    inputs: overlap pickle, dataset pickles. outputs: one pickle per dataset.
+    '''
+    overlap = pickle.load(open(inputs[0], 'rb'))
+    rows = {}
+    for relFilePath, outPath in zip(inputs[1:], outputs):
+        dataset = rfunc.redistrict_drop(pickle.load(open(relFilePath, 'rb')), overlap, threshold_for_change)
+        save_frame(dataset, [outPath])
+        rows[os.path.basename(outPath)] = len(dataset)
+    return rows
+
+def models_stage(inputs, outputs, feature_sets=FEATURE_SETS, models=('LogReg', 'Random Forest'), y_col=('dem_win',),
+                 upsample=(False, True), score='accuracy_score'):
+    '''Scores of every model on every dataset and feature set, as model_submit.ipynb.
+    inputs: dataset pickles. outputs: score table pickle.
+    '''
+    from sklearn.linear_model import LogisticRegression
+    from sklearn.ensemble import RandomForestClassifier
+    from functions import modelFunctions as mfunc
+
+    #the features are not scaled, lbfgs needs more than its default 100 iterations to converge on them
+    model_dict = {'LogReg': LogisticRegression(max_iter=1000), 'Random Forest': RandomForestClassifier(random_state=209)}
+    results, splits = mfunc.evaluate_grid(inputs, feature_sets, {name: model_dict[name] for name in models},
+                                          list(y_col), upsample=list(upsample))
+    scores = mfunc.score_table(results, splits, score)
+    pickle.dump(scores, open(outputs[0], 'wb'))
+    return {'scores': len(scores)}
+
+def shapefiles(years, shapeDir='district_shapefiles'):
+    '''Files of the district shapes of some elections, see overlapFunctions.shapefile_path().
+    arguments:
+        years -- election years (list of ints)
+        shapeDir -- see overlapFunctions.shapefile_path() (str)
+    returns:
+        paths of the .shp, .shx and .dbf files (list of str)
+    '''
+    paths = []
+    for year in years:
+        shpPath = ofunc.shapefile_path(year, shapeDir)
+        paths += [shpPath, shpPath[:-4] + '.shx', shpPath[:-4] + '.dbf']
+    return paths
+
+HOUSE = 'functions.houseFunctions'
+INGEST = 'functions.ingestFunctions'
+
+def default_stages():
+    '''The preprocessing pipeline of this repository.
+    returns:
+        stages (list of Stage)
+    '''
+    base = ifunc.BASE_DATASET
+    with_csv = lambda relFilePath: [relFilePath, relFilePath[:-2] + '.csv']
+    redistricted = [base, DEMOGRAPHICS, DEMOGRAPHICS_IMPUTED]
+    years_to_read = sorted(set(OVERLAP_YEARS) | {year - 2 for year in OVERLAP_YEARS})
+    return [
+        Stage('results', results_stage,
+              ['Datasets/fec/1976-2016-house.csv', 'Datasets/fec/2018wiki-12072018.csv'],
+              [ifunc.RESULTS_PATH, 'Datasets/master_index.p'], {}, [HOUSE, INGEST]),
+        Stage('national_poll', national_poll_stage,
+              ['Datasets/master_index.p'] + ['Datasets/{}_generic_congressional_vote.csv'.format(year)
+                                             for year in POLL_YEARS],
+              ['Datasets/national_poll.p'], {}, [HOUSE, 'functions.pollFunctions']),
+        Stage('trimmed_data', trimmed_data_stage, [ifunc.RESULTS_PATH, 'Datasets/national_poll.p'],
+              with_csv(base), {}, [HOUSE, INGEST]),
+        Stage('demographics', demographics_stage, [base] + ACS_FILES,
+              with_csv(DEMOGRAPHICS) + with_csv(DEMOGRAPHICS_IMPUTED), {},
+              [HOUSE, INGEST, 'functions.demographicsFunctions']),
+        Stage('overlap', overlap_stage, ['Datasets/master_index.p'] + shapefiles(years_to_read), [OVERLAP_PATH],
+              {}, [HOUSE, 'functions.overlapFunctions']),
+        Stage('redistricting', redistricting_stage, [OVERLAP_PATH] + redistricted,
+              [relFilePath[:-2] + '_REDISTRICTDROP.p' for relFilePath in redistricted], {},
+              [HOUSE, INGEST, 'functions.redistrictingFunctions', 'functions.crosswalkFunctions',
+               'functions.overlapFunctions']),
+        Stage('models', models_stage, MODEL_DATASETS, [SCORES_PATH], {},
+              ['functions.modelFunctions', 'functions.featureStore']),
+    ]
+
+def stage_graph(stages):
+    '''Stages each stage waits for, the stages writing its inputs.
+    arguments:
+        stages -- stages (list of Stage)
+    returns:
+        names of the upstream stages keyed by stage name (dict of sets)
+    '''
+    writers = {}
+    for stage in stages:
+        for relFilePath in stage.outputs:
+            if relFilePath in writers:
+                raise ValueError('{} is written by {} and {}'.format(relFilePath, writers[relFilePath], stage.name))
+            writers[relFilePath] = stage.name
+    graph = {stage.name: {writers[path] for path in stage.inputs if path in writers} - {stage.name}
+             for stage in stages}
+
+    #topological sort, anything left over is on a cycle
+    done, pending = set(), dict(graph)
+    while pending:
+        ready = [name for name, upstream in pending.items() if upstream <= done]
+        if not ready:
+            raise ValueError('the stages {} depend on each other'.format(sorted(pending)))
+        for name in ready:
+            done.add(name)
+            del pending[name]
+    return graph
+
+_hashes = {}
+def cached_file_hash(relFilePath):
+    '''sha256 of a file, remembered while its size and modification time stay the same.
+    arguments:
+        relFilePath -- path to the file (str)
+    returns:
+        hex digest (str)
+    '''
+    stat = os.stat(relFilePath)
+    key = (os.path.abspath(relFilePath), stat.st_size, stat.st_mtime_ns)
+    if key not in _hashes:
+        _hashes[key] = fstore.file_hash(relFilePath)
+    return _hashes[key]
+
+def stage_key(stage):
+    '''Hash of everything a stage's outputs depend on: name, parameters, code and input files.
+    The parameters are the ones the stage function runs with, defaults included, so changing a default
+    (e.g. FEATURE_SETS) runs the stage again.
+    arguments:
+        stage -- stage whose inputs all exist (Stage)
+    returns:
+        hex digest (str)
+    '''
+    bound = inspect.signature(stage.func).bind(list(stage.inputs), list(stage.outputs), **stage.params)
+    bound.apply_defaults()
+    params = {name: value for name, value in list(bound.arguments.items())[2:]}
+    config = {'name': stage.name, 'params': params, 'code': inspect.getsource(stage.func),
+              'modules': {module: cached_file_hash(importlib.util.find_spec(module).origin)
+                          for module in stage.modules},
+              'inputs': {path: cached_file_hash(path) for path in stage.inputs}}
+    return hashlib.sha256(json.dumps(config, sort_keys=True, default=str).encode()).hexdigest()[:20]
+
+def _run_stage(stage):
+    start = time.time()
+    rows = stage.func(list(stage.inputs), list(stage.outputs), **stage.params)
+    seconds = time.time() - start
+    #ru_maxrss is in kB on linux, the stage's own process pools count as children
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)/1024.
+    return {'seconds': seconds, 'peak_rss_mb': peak, 'rows': rows}
+
+def cache_lookup(stage, key, cacheDir=CACHE_DIR):
+    '''Bring a stage's outputs up to date from the cache. Outputs that were changed on disk since the cached run
+    (e.g. by ingestFunctions.ingest_cycle()) are newer than the cache and are left alone.
+    arguments:
+        stage -- stage (Stage)
+        key -- output of stage_key() (str)
+        cacheDir -- directory holding the cached outputs (str)
+    returns:
+        'cached' if the outputs on disk are the cached ones, 'kept' if some were changed on disk, 'restored' if
+        missing outputs were copied back from the cache, None if the key is not in the cache (str)
+        manifest of the cached run (dict)
+    '''
+    entryDir = os.path.join(cacheDir, stage.name, key)
+    if not os.path.exists(os.path.join(entryDir, MANIFEST)):
+        return None, None
+    manifest = json.load(open(os.path.join(entryDir, MANIFEST)))
+    if any(os.path.exists(path) and cached_file_hash(path) != manifest['outputs'][path] for path in stage.outputs):
+        return 'kept', manifest
+    missing = [i for i, path in enumerate(stage.outputs) if not os.path.exists(path)]
+    for i in missing:
+        shutil.copyfile(os.path.join(entryDir, str(i)), stage.outputs[i])
+    return ('restored' if missing else 'cached'), manifest
+
+def cache_store(stage, key, run, cacheDir=CACHE_DIR):
+    '''Keep a copy of a stage's outputs under its key.
+    arguments:
+        stage -- stage (Stage)
+        key -- output of stage_key() (str)
+        run -- output of the stage run, see run_pipeline() (dict)
+        cacheDir -- directory holding the cached outputs (str)
+    '''
+    entryDir = os.path.join(cacheDir, stage.name, key)
+    os.makedirs(entryDir, exist_ok=True)
+    for i, path in enumerate(stage.outputs):
+        shutil.copyfile(path, os.path.join(entryDir, str(i)))
+    manifest = dict(run, outputs={path: cached_file_hash(path) for path in stage.outputs})
+    #the manifest goes last, an entry without one is incomplete
+    json.dump(manifest, open(os.path.join(entryDir, MANIFEST), 'w'), indent=1)
+
+def run_pipeline(stages=None, targets=None, force=(), n_jobs=None, cacheDir=CACHE_DIR, dry_run=False,
+                 verbose=True):
+    '''Bring the outputs of a pipeline up to date.
+    arguments:
+        stages -- stages, defaults to default_stages() (list of Stage)
+        targets -- stages to bring up to date together with the stages they depend on, None runs all (list of str)
+        force -- stages to run even if their outputs are cached (list of str)
+        n_jobs -- number of stages running at the same time, None uses every core (int)
+        cacheDir -- directory holding the cached outputs (str)
+        dry_run -- only report what would run: 'run' for stages with an unknown key or an upstream stage that
+                   runs, 'missing' for stages whose inputs or outputs are missing (bool)
+        verbose -- print every stage when it is done (bool)
+    returns:
+        one row per stage with its 'status' (ran, cached, restored or kept), wall time in 'seconds', 'peak_rss_mb'
+        of the worker that ran it and output 'rows' (pandas.dataframe)
+    '''
+    stages = {stage.name: stage for stage in (default_stages() if stages is None else stages)}
+    graph = stage_graph(list(stages.values()))
+    unknown = (set(targets or ()) | set(force)) - set(stages)
+    if unknown:
+        raise KeyError('unknown stages {}'.format(sorted(unknown)))
+
+    #the targets and everything upstream of them
+    wanted = set(stages if targets is None else targets)
+    while True:
+        upstream = set().union(*[graph[name] for name in wanted]) - wanted
+        if not upstream:
+            break
+        wanted |= upstream
+    order = [name for name in stages if name in wanted]
+
+    report, pending, running, done = {}, list(order), {}, set()
+    started = time.time()
+    if verbose:
+        print('{:<14} {:<9} {:>9} {:>11}  {}'.format('stage', 'status', 'wall', 'peak rss', 'rows'))
+
+    def finish(name, status, seconds, peak=float('nan'), rows=None):
+        report[name] = {'status': status, 'seconds': seconds, 'peak_rss_mb': peak,
+                        'rows': ', '.join('{}={}'.format(label, n) for label, n in (rows or {}).items())}
+        done.add(name)
+        if verbose:
+            memory = '' if peak != peak else '{:.1f}MB'.format(peak)
+            print('{:<14} {:<9} {:8.2f}s {:>11}  {}'.format(name, status, seconds, memory, report[name]['rows']))
+
+    def start(pool, name):
+        '''Check a ready stage against the cache, submit it to the pool if it has to run.'''
+        stage, tic = stages[name], time.time()
+        written = set().union(*[stages[upstream].outputs for upstream in graph[name]])
+        missing = [path for path in stage.inputs if not os.path.exists(path) and not (dry_run and path in written)]
+        if dry_run and any(report[upstream]['status'] == 'run' for upstream in graph[name]) and not missing:
+            return finish(name, 'run', 0.)
+        if missing:
+            if all(os.path.exists(path) for path in stage.outputs):
+                return finish(name, 'kept', time.time() - tic)
+            if dry_run:
+                return finish(name, 'missing', time.time() - tic)
+            raise FileNotFoundError('{} is missing {}'.format(name, missing[:3]))
+
+        key = stage_key(stage)
+        if dry_run:
+            cached = name not in force and os.path.exists(os.path.join(cacheDir, name, key, MANIFEST))
+            return finish(name, 'cached' if cached else 'run', time.time() - tic)
+        if name not in force:
+            status, manifest = cache_lookup(stage, key, cacheDir)
+            if status is not None:
+                return finish(name, status, time.time() - tic, rows=manifest['rows'])
+        running[pool.submit(_run_stage, stage)] = (name, key)
+
+    #a fresh worker per stage, so its peak memory is its own
+    with ProcessPoolExecutor(max_workers=n_jobs, max_tasks_per_child=1) as pool:
+        while pending or running:
+            for name in [name for name in pending if graph[name] <= done]:
+                pending.remove(name)
+                start(pool, name)
+            if not running:
+                continue
+            finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in finished:
+                name, key = running.pop(future)
+                run = future.result()
+                cache_store(stages[name], key, run, cacheDir)
+                finish(name, 'ran', run['seconds'], run['peak_rss_mb'], run['rows'])
+
+    if verbose:
+        print('pipeline done in {:.2f}s'.format(time.time() - started))
+    return pd.DataFrame([dict(report[name], stage=name) for name in order],
+                        columns=['stage', 'status', 'seconds', 'peak_rss_mb', 'rows']).set_index('stage')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Bring the preprocessed datasets up to date.')
+    parser.add_argument('targets', nargs='*', help='stages to bring up to date, all by default')
+    parser.add_argument('--force', nargs='+', default=[], help='stages to run even if they are cached')
+    parser.add_argument('--jobs', type=int, default=None, help='number of stages running at the same time')
+    parser.add_argument('--cache', default=CACHE_DIR, help='directory holding the cached outputs')
+    parser.add_argument('--dry-run', action='store_true', help='only report what would run')
+    args = parser.parse_args()
+    run_pipeline(targets=args.targets or None, force=args.force, n_jobs=args.jobs, cacheDir=args.cache,
+                 dry_run=args.dry_run)
@@ -0,0 +1,148 @@
+import os
+import datetime
+import numpy as np
+import pandas as pd
+'''
+National generic congressional ballot polls (Datasets/YYYY_generic_congressional_vote.csv, from RealClearPolitics).
+
+All years are read once into one long table of polls. Polls are sorted by how many days before election day they
+ended, so the mean spread of every window of a whole grid comes out of cumulative sums in one pass.
+Spread is standardized around 0: democrats - republicans.
+'''
+
+#the party columns were renamed in 2014
+PARTY_COLUMNS = {'Democrats': 'dem', 'Republicans': 'rep', 'Democrats (D)': 'dem', 'Republicans (R)': 'rep'}
+SUMMARY_ROWS = ('Final Results', 'RCP Average')
+
+def get_election_day(year):
+    ''' Get the date of election day in a given year, the Tuesday after the first Monday of November.
+    arguments:
+        year -- year as int
+    returns:
+        datetime object of election day. '''
+    if year%2 == 1:
+        raise ValueError('No election in odd years.')
+    # possible days = Nov. 2 - Nov. 8
+    first = datetime.datetime(year, 11, 2)
+    return first + datetime.timedelta(days=(1 - first.weekday()) % 7)
+
+def read_polls(year, relDir='Datasets'):
+    ''' Read the polls of one election year into the common schema.
+    arguments:
+        year -- (int) the year you want to pull poll data from, there must be a file named
+                '<relDir>/YYYY_generic_congressional_vote.csv'
+        relDir -- folder holding the poll files (str)
+    returns:
+        dataframe with one row per poll and the columns 'year', 'poll', 'start', 'end', 'days_before' (days between
+        the end of the poll and election day), 'start_offset' (days from election day to the start date read in the
+        election year, what the original cutoff compared), 'sample', 'dem', 'rep' and 'spread' (pandas.dataframe)
+    '''
+    ballot_df = pd.read_csv(os.path.join(relDir, '{}_generic_congressional_vote.csv'.format(year)))
+    ballot_df = ballot_df[~ballot_df['Poll'].isin(SUMMARY_ROWS)].rename(columns=PARTY_COLUMNS)
+    election_day = pd.Timestamp(get_election_day(year))
+
+    # dates are 'MM/DD - MM/DD' without a year
+    dates = ballot_df['Date'].str.split('-', expand=True)
+    start = pd.to_datetime(str(year) + '/' + dates[0].str.strip(), format='%Y/%m/%d')
+    end = pd.to_datetime(str(year) + '/' + dates[1].str.strip(), format='%Y/%m/%d')
+    start_offset = (start - election_day).dt.days
+    # polls ending over a month after the election are from december of the year before,
+    # polls running over new year started the year before
+    last_year = end > election_day + pd.Timedelta(days=30)
+    start[last_year] -= pd.DateOffset(years=1)
+    end[last_year] -= pd.DateOffset(years=1)
+    start[start > end + pd.Timedelta(days=180)] -= pd.DateOffset(years=1)
+
+    # sample is e.g. '1000 LV', 'RV' or '--'
+    sample = pd.to_numeric(ballot_df['Sample'].str.extract(r'(\d+)', expand=False), errors='coerce')
+    return pd.DataFrame({'year': year, 'poll': ballot_df['Poll'].values, 'start': start.values, 'end': end.values,
+                         'days_before': (election_day - end).dt.days.values, 'start_offset': start_offset.values,
+                         'sample': sample.values,
+                         'dem': ballot_df['dem'].values.astype(float), 'rep': ballot_df['rep'].values.astype(float),
+                         'spread': (ballot_df['dem'] - ballot_df['rep']).values.astype(float)})
+
+def load_polls(years, relDir='Datasets'):
+    ''' Read the polls of every year once.
+    arguments:
+        years -- (list) election years to read
+        relDir -- folder holding the poll files (str)
+    returns:
+        polls of all years, see read_polls() (pandas.dataframe)
+    '''
+    return pd.concat([read_polls(year, relDir) for year in years], ignore_index=True)
+
+def poll_weights(polls, sample_weight=False, half_life=None):
+    ''' Weight of each poll in the mean spread.
+    arguments:
+        polls -- output of load_polls() (pandas.dataframe)
+        sample_weight -- weight polls by their sample size, polls without one get the median size of their year (bool)
+        half_life -- weight polls by recency, halving every half_life days before election day (float)
+    returns:
+        weights (numpy.array of floats)
+    '''
+    weights = np.ones(len(polls))
+    if sample_weight:
+        sample = polls['sample'].fillna(polls.groupby('year')['sample'].transform('median')).fillna(1.)
+        weights *= sample.values
+    if half_life is not None:
+        weights *= 0.5**(np.clip(polls['days_before'].values, 0, None)/half_life)
+    return weights
+
+def poll_table(polls, windows=(None,), sample_weight=False, half_life=None, legacy_cutoff=28):
+    ''' Mean spread of the polls of each year for a grid of windows, in one vectorized pass.
+    arguments:
+        polls -- output of load_polls() (pandas.dataframe)
+        windows -- maximum number of days before the election a poll should end to be counted.
+                   None is the cutoff of the original get_mean_spread(), see legacy_cutoff (list)
+        sample_weight -- see poll_weights() (bool)
+        half_life -- see poll_weights() (float)
+        legacy_cutoff -- n_days_before_election of the original cutoff (start - election_day).days <= n, which
+                         counts every poll of the year up to n days after the election. The national_poll of
+                         Datasets/national_poll.p is made with 28. (int)
+    returns:
+        mean spread with one row per year and one column per window, the column of None is labelled 'legacy'.
+        nan where a window has no polls. (pandas.dataframe)
+    '''
+    years = np.sort(polls['year'].unique())
+    weights = poll_weights(polls, sample_weight, half_life)
+    columns = {}
+
+    # sort by year then by days before election, a window is then a contiguous run of each year
+    order = np.lexsort((polls['days_before'].values, polls['year'].values))
+    days = polls['days_before'].values[order]
+    span = 4*(int(np.abs(days).max()) + 1) if len(days) else 1
+    year_keys = np.arange(len(years))*span
+    sorted_keys = np.searchsorted(years, polls['year'].values[order])*span + days
+    cum_weight = np.r_[0., np.cumsum(weights[order])]
+    cum_spread = np.r_[0., np.cumsum(weights[order]*polls['spread'].values[order])]
+
+    # only polls that ended by election day count, windows longer than the data are capped inside their year
+    grid = [window for window in windows if window is not None]
+    if grid:
+        first = np.searchsorted(sorted_keys, year_keys, side='left')[:, None]
+        last = np.searchsorted(sorted_keys, year_keys[:, None] + np.minimum(grid, span//2)[None, :], side='right')
+        total = cum_weight[last] - cum_weight[first]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = np.where(total > 0, (cum_spread[last] - cum_spread[first])/total, np.nan)
+        columns.update(zip(grid, means.T))
+
+    if any(window is None for window in windows):
+        counted = (polls['start_offset'] <= legacy_cutoff).values
+        weighted = pd.DataFrame({'year': polls['year'].values[counted], 'weight': weights[counted],
+                                 'spread': weights[counted]*polls['spread'].values[counted]}).groupby('year').sum()
+        columns['legacy'] = (weighted['spread']/weighted['weight']).reindex(years).values
+
+    labels = ['legacy' if window is None else window for window in windows]
+    return pd.DataFrame({label: columns[label] for label in labels}, index=pd.Index(years, name='year'),
+                        columns=labels)
+
+def national_poll(table, window='legacy'):
+    ''' One window of a poll table as the national poll of each year, in the form the lag features take it
+    (see houseFunctions.fetch_trimmed_data()).
+    arguments:
+        table -- output of poll_table() (pandas.dataframe)
+        window -- column of the table (int or 'legacy')
+    returns:
+        national poll indexed by year (pandas.series)
+    '''
+    return table[window].rename('national_poll')
@@ -0,0 +1,124 @@
+import pickle
+import numpy as np
+import pandas as pd
+import shapely
+from functions import houseFunctions as hfunc
+from functions import crosswalkFunctions as cwalk
+'''
+Redistricting corrections of redistricting-corrections.ipynb: drop the districts whose borders changed since the
+previous election and attach the district centroids, each as one join against all_overlap_data.p.
+
+overlap -- dataframe indexed ST_DD_YYYY with the columns 'year', 'overlap_frac', 'border_change' and 'centroid',
+           as written by district_shapefiles/overlap_area.ipynb
+'''
+
+def border_change(overlap, threshold_for_change=None):
+    '''Whether each district changed since the previous election (1) or not (0).
+    arguments:
+        overlap -- overlap data (pandas.dataframe)
+        threshold_for_change -- fraction of a district's area that may move before it counts as changed.
+                                None uses the 'border_change' column as stored, otherwise it is recomputed
+                                from 'overlap_frac' with the same rule as overlapFunctions.district_overlap() (float)
+    returns:
+        border change, nan for districts that were not checked (pandas.series of floats)
+    '''
+    if threshold_for_change is None:
+        return overlap['border_change'].astype(float)
+
+    checked = overlap['overlap_frac'].map(lambda overlap_dict: isinstance(overlap_dict, dict)).values
+    keys = hfunc.index_to_key(overlap.index)
+    keys_prev = hfunc.previous_key(keys)
+    crosswalks = cwalk.crosswalks_from_frame(overlap, 'overlap_frac')
+
+    #area fraction each district keeps from its namesake of the previous election, 0 if it has none
+    kept = np.zeros(len(keys))
+    if crosswalks:
+        crosswalk = cwalk.stack_crosswalks(crosswalks)
+        rows = pd.Index(crosswalk.keys).get_indexer(keys)
+        cols = pd.Index(crosswalk.keys_from).get_indexer(keys_prev)
+        found = (rows >= 0) & (cols >= 0)
+        kept[found] = np.asarray(crosswalk.matrix[rows[found], cols[found]]).ravel()
+        found &= np.isin(keys_prev, keys) # new, or in a totally new location
+    else:
+        found = np.zeros(len(keys), dtype=bool)
+
+    changed = (~found | (1.-kept > threshold_for_change))*1.
+    return pd.Series(np.where(checked, changed, np.nan), index=overlap.index, name='border_change')
+
+def drop_redistricted(dataset, overlap, threshold_for_change=None):
+    '''Drop the rows of districts whose borders changed since the previous election.
+    arguments:
+        dataset -- dataset indexed ST_DD_YYYY (pandas.dataframe)
+        overlap -- overlap data (pandas.dataframe)
+        threshold_for_change -- see border_change() (float)
+    returns:
+        rows of dataset whose district did not change (pandas.dataframe)
+    '''
+    changed = border_change(overlap, threshold_for_change)
+    return dataset[~dataset.index.isin(changed.index[changed == 1])]
+
+def centroid_coords(centroids):
+    '''Longitude and latitude of district centroids.
+    arguments:
+        centroids -- centroids as shapely points or coordinate sequences of a point, including the coordinate
+                     sequences pickled by shapely 1.x (pandas.series)
+    returns:
+        dataframe with the columns 'longitude' and 'latitude', nan where there is no centroid (pandas.dataframe)
+    '''
+    def as_point(centroid):
+        if isinstance(centroid, shapely.Geometry):
+            return centroid
+        parent = getattr(centroid, '__dict__', {}).get('__p__') # shapely 1.x coordinate sequence
+        if isinstance(parent, shapely.Geometry):
+            return parent
+        try:
+            return shapely.Point(centroid[0])
+        except (TypeError, IndexError, ValueError):
+            return None
+
+    points = np.array([as_point(centroid) for centroid in centroids], dtype=object)
+    return pd.DataFrame({'longitude': shapely.get_x(points), 'latitude': shapely.get_y(points)},
+                        index=centroids.index)
+
+def add_centroids(dataset, overlap):
+    '''Add the 'longitude' and 'latitude' of each district's centroid to a dataset.
+    arguments:
+        dataset -- dataset indexed ST_DD_YYYY (pandas.dataframe)
+        overlap -- overlap data (pandas.dataframe)
+    returns:
+        dataset with the columns 'longitude' and 'latitude' (pandas.dataframe)
+    '''
+    coords = centroid_coords(overlap['centroid'])
+    coords = coords[~coords.index.duplicated(keep='first')].reindex(dataset.index)
+    dataset = dataset.copy()
+    dataset['longitude'] = coords['longitude'].values
+    dataset['latitude'] = coords['latitude'].values
+    return dataset
+
+def redistrict_drop(dataset, overlap, threshold_for_change=None):
+    '''Drop redistricted districts and add centroids, the *_REDISTRICTDROP variant of a dataset.
+    arguments:
+        dataset -- dataset indexed ST_DD_YYYY (pandas.dataframe)
+        overlap -- overlap data (pandas.dataframe)
+        threshold_for_change -- see border_change() (float)
+    returns:
+        corrected dataset (pandas.dataframe)
+    '''
+    return add_centroids(drop_redistricted(dataset, overlap, threshold_for_change), overlap)
+
+def redistrict_drop_file(relFilePath, overlapPath='Datasets/all_overlap_data.p', threshold_for_change=None,
+                         save=True):
+    '''Make the *_REDISTRICTDROP variant of a pickled dataset.
+    arguments:
+        relFilePath -- path to the pickled dataset, e.g. Datasets/data_FEC_NATIONALPOLL_2004_2018.p (str)
+        overlapPath -- path to the pickled overlap data (str)
+        threshold_for_change -- see border_change() (float)
+        save -- pickle the result next to the dataset with the suffix _REDISTRICTDROP (bool)
+    returns:
+        corrected dataset (pandas.dataframe)
+    '''
+    overlap = pickle.load(open(overlapPath, 'rb'))
+    dataset = redistrict_drop(pickle.load(open(relFilePath, 'rb')), overlap, threshold_for_change)
+    if save:
+        pickle.dump(dataset, open(relFilePath[:-2] + '_REDISTRICTDROP.p', 'wb'))
+    return dataset
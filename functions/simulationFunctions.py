@@ -0,0 +1,187 @@
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from functions import houseFunctions as hfunc
+'''
+Monte Carlo seat counts on top of a fitted classifier (anything with predict_proba, e.g. from model_submit.ipynb).
+
+Every scenario draws one national swing of the generic ballot (shared by all districts, which is what correlates
+them), optionally one shock per state, and one shock per district. The model is only evaluated on a grid of
+national swings; each scenario picks a grid point next to its swing, adds its shocks and draws the winners.
+District shocks only blur each district's own odds, so they are integrated out rather than drawn. Scenarios are
+processed in chunks of batched array operations so memory stays bounded, the chunks run in a thread pool.
+
+Swings are in national_poll units (democrat - republican spread, in points), shocks are in log odds.
+'''
+
+#features of houseFunctions.fetch_trimmed_data() that move with this cycle's national poll
+POLL_COL = 'national_poll'
+
+def shift_poll(X, swing):
+    '''Feature matrix with this cycle's national poll shifted, the poll features derived from it follow.
+    arguments:
+        X -- feature matrix of the cycle (pandas.dataframe)
+        swing -- change of national_poll (float)
+    returns:
+        shifted copy of X (pandas.dataframe)
+    '''
+    X = X.copy()
+    if POLL_COL not in X.columns:
+        raise KeyError('the feature matrix has no {} column to shift'.format(POLL_COL))
+    poll = X[POLL_COL].astype(float)
+    X[POLL_COL] = poll + swing
+    if 'national_poll_delta_subtract' in X.columns:
+        X['national_poll_delta_subtract'] = X['national_poll_delta_subtract'] + swing
+    if 'national_poll_delta_divide' in X.columns:
+        if 'national_poll_prev' in X.columns:
+            X['national_poll_delta_divide'] = (poll + swing)/X['national_poll_prev']
+        else:
+            X['national_poll_delta_divide'] = X['national_poll_delta_divide']*(poll + swing)/poll
+    return X
+
+def swing_curves(model, X, swings, positive_class=1):
+    '''Log odds of the positive class (democrat win) of every district at every national swing of a grid.
+    arguments:
+        model -- fitted classifier with predict_proba
+        X -- feature matrix of the cycle, one row per district (pandas.dataframe)
+        swings -- national swings to evaluate, increasing (array-like of floats)
+        positive_class -- class whose probability is simulated (int)
+    returns:
+        log odds, one row per swing and one column per district (numpy.array)
+    '''
+    column = list(model.classes_).index(positive_class)
+    X_grid = pd.concat([shift_poll(X, swing) for swing in swings], ignore_index=True)
+    prob = model.predict_proba(X_grid)[:, column].reshape(len(swings), len(X))
+    prob = np.clip(prob, 1e-6, 1 - 1e-6) # keep the log odds of certain districts finite
+    return np.log(prob) - np.log1p(-prob)
+
+def district_states(index):
+    '''State of every district of an index.
+    arguments:
+        index -- legacy ST_DD_YYYY index, of object or str dtype, or integer keys of houseFunctions.encode_key()
+                 (pandas.Index)
+    returns:
+        state abbreviations, None if the index holds neither (numpy.array)
+    '''
+    if pd.api.types.is_integer_dtype(index):
+        return hfunc.decode_key(index)[0]
+    if pd.api.types.is_string_dtype(index):
+        return np.asarray(pd.Index(index).astype(str).str[:2], dtype=object)
+    return None
+
+def simulate_seats(model, X, n_scenarios=1000000, swing_mean=0., swing_sd=3., district_sd=0.5, state_sd=0.,
+                   states=None, prev_dem=None, swings=None, chunk_size=20000, seed=None, n_jobs=None):
+    '''Simulate the seats won by each party over many correlated scenarios.
+    arguments:
+        model -- fitted classifier with predict_proba, class 1 = democrat win (e.g. y_col = ['dem_win'])
+        X -- feature matrix of the cycle with the predictors the model was fitted on, one row per district and a
+             national_poll column (pandas.dataframe)
+        n_scenarios -- number of scenarios (int)
+        swing_mean -- mean national swing of national_poll (float)
+        swing_sd -- standard deviation of the national swing (float)
+        district_sd -- standard deviation of the per-district shock, in log odds. These shocks are integrated out
+                       with the probit approximation of the logistic-normal integral rather than drawn (float)
+        state_sd -- standard deviation of a shock shared by the districts of a state, in log odds (float)
+        states -- state of every district, needed for per-state totals and state shocks, defaults to the state
+                  in the index of X, see district_states() (array-like)
+        prev_dem -- 1 where the district was won by a democrat last time (dem_win_prev), for the flip
+                    probabilities (array-like)
+        swings -- grid of national swings the model is evaluated on, defaults to 201 points over +-5 swing_sd
+                  (array-like of floats). Scenario swings are clipped to the grid.
+        chunk_size -- scenarios per batch, memory is a few arrays of chunk_size x districts floats (int)
+        seed -- random seed (int)
+        n_jobs -- number of threads running chunks, None uses every core (int)
+    returns:
+        dictionary with
+            'seat_hist' -- number of scenarios in which democrats win 0..n districts (numpy.array)
+            'seats_mean' -- mean democrat seats (float)
+            'majority_prob' -- share of scenarios with a democrat majority (float)
+            'dem_prob' -- probability that each district elects a democrat (pandas.series)
+            'flip_prob' -- probability that each district changes party, if prev_dem is given (pandas.series)
+            'state_seats' -- mean democrat seats, 5th and 95th percentile and number of districts of each state,
+                             if states are known (pandas.dataframe)
+    '''
+    n_districts = len(X)
+    if states is None:
+        states = district_states(X.index)
+    if swings is None:
+        swings = swing_mean + max(swing_sd, 0.2)*np.linspace(-5, 5, 201)
+    swings = np.asarray(swings, dtype=float)
+    # the district shocks are independent of everything else, so they are integrated out instead of drawn:
+    # E[sigmoid(x + district_sd*z)] ~ sigmoid(x/sqrt(1 + pi*district_sd**2/8)), which is linear in x
+    scale = 1/np.sqrt(1 + np.pi*district_sd**2/8)
+    curves = scale*swing_curves(model, X, swings)
+    if state_sd > 0:
+        curves = curves.astype(np.float32)
+    else:
+        # without state shocks a district is won where 32 random bits fall below a fixed threshold per grid point
+        thresholds = np.floor(2.**32/(1 + np.exp(-curves))).clip(0, 2**32 - 1).astype(np.uint32)
+
+    if states is not None:
+        state_names, state_pos = np.unique(np.asarray(states), return_inverse=True)
+        n_states = len(state_names)
+        state_size = np.bincount(state_pos, minlength=n_states)
+        # histogram of seats won per state: row = state, column = seats
+        state_hist = np.zeros(n_states*(state_size.max() + 1), dtype=np.int64)
+        state_offset = np.arange(n_states)*(state_size.max() + 1)
+        state_onehot = np.zeros((n_districts, n_states), dtype=np.float32)
+        state_onehot[np.arange(n_districts), state_pos] = 1.
+    elif state_sd > 0:
+        raise ValueError('state shocks need the state of every district')
+
+    def run_chunk(n, seed_seq):
+        rng = np.random.default_rng(seed_seq)
+
+        # national swing, rounded to one of the two grid points around it with odds given by its distance to
+        # each, so district probabilities are linearly interpolated on average
+        swing = np.clip(swing_mean + swing_sd*rng.standard_normal(n), swings[0], swings[-1])
+        cell = np.clip(np.searchsorted(swings, swing, side='right') - 1, 0, len(swings) - 2)
+        cell += rng.random(n) < (swing - swings[cell])/(swings[cell + 1] - swings[cell])
+
+        if state_sd > 0:
+            # democrats win where a uniform draw falls below sigmoid(log odds + state shock)
+            log_odds = curves[cell]
+            log_odds += (scale*state_sd*rng.standard_normal((n, n_states), dtype=np.float32))[:, state_pos]
+            np.negative(log_odds, out=log_odds)
+            np.exp(log_odds, out=log_odds)
+            log_odds += 1.
+            wins = rng.random((n, n_districts), dtype=np.float32)*log_odds < 1.
+        else:
+            bits = rng.bit_generator.random_raw((n*n_districts + 1)//2).view(np.uint32)[:n*n_districts]
+            wins = bits.reshape(n, n_districts) < thresholds[cell]
+
+        counts = {'seats': np.bincount(wins.sum(axis=1), minlength=n_districts + 1), 'dem_wins': wins.sum(axis=0)}
+        if states is not None:
+            state_seats = (wins.astype(np.float32) @ state_onehot).astype(np.int64)
+            counts['state_hist'] = np.bincount((state_seats + state_offset).ravel(), minlength=len(state_hist))
+        return counts
+
+    # every chunk has its own random stream, so results don't depend on how many threads run them
+    sizes = [min(chunk_size, n_scenarios - start) for start in range(0, n_scenarios, chunk_size)]
+    seed_seqs = np.random.SeedSequence(seed).spawn(len(sizes))
+    seat_hist = np.zeros(n_districts + 1, dtype=np.int64)
+    dem_wins = np.zeros(n_districts, dtype=np.int64)
+    with ThreadPoolExecutor(max_workers=n_jobs) as pool: # numpy releases the GIL on the big array operations
+        for counts in pool.map(run_chunk, sizes, seed_seqs):
+            seat_hist += counts['seats']
+            dem_wins += counts['dem_wins']
+            if states is not None:
+                state_hist += counts['state_hist']
+
+    seat_values = np.arange(n_districts + 1)
+    result = {'seat_hist': seat_hist,
+              'seats_mean': (seat_hist*seat_values).sum()/n_scenarios,
+              'majority_prob': seat_hist[seat_values > n_districts/2].sum()/n_scenarios,
+              'dem_prob': pd.Series(dem_wins/n_scenarios, index=X.index, name='dem_prob')}
+    if prev_dem is not None:
+        prev_dem = np.asarray(prev_dem, dtype=float)
+        result['flip_prob'] = pd.Series(np.where(prev_dem == 1, 1 - result['dem_prob'].values,
+                                                 result['dem_prob'].values), index=X.index, name='flip_prob')
+    if states is not None:
+        state_hist = state_hist.reshape(n_states, -1)
+        cdf = np.cumsum(state_hist, axis=1)/n_scenarios
+        result['state_seats'] = pd.DataFrame({
+            'seats_mean': (state_hist*np.arange(state_hist.shape[1])).sum(axis=1)/n_scenarios,
+            'seats_p05': (cdf < 0.05).sum(axis=1), 'seats_p95': (cdf < 0.95).sum(axis=1),
+            'districts': state_size}, index=pd.Index(state_names, name='state'))
+    return result
@@ -0,0 +1,66 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+from functions import featureStore as fstore
+from functions import houseFunctions as hfunc
+
+def overlap_frame():
+    index = hfunc.key_to_index(hfunc.encode_key(np.array(['AL', 'AL', 'WI']), np.array([1, 2, 1]), np.array([2016, 2018, 2018])))
+    return pd.DataFrame({'year': [2016, 2018, 2018], 'state': ['AL', 'AL', 'WI'],
+                         'overlap_frac': [np.nan, {'AL_01_2016': 1.0}, {'WI_01_2016': 0.9, 'WI_02_2016': 0.1}],
+                         'centroid': [(1.0, 2.0), (1.5, 2.5), None]}, index=index)
+
+def test_object_columns_round_trip(tmp_path):
+    df = overlap_frame()
+    manifest = fstore.write_store(df, str(tmp_path / 'store'))
+    assert {meta['name']: meta['kind'] for meta in manifest['columns']}['overlap_frac'] == 'pickle'
+    back = fstore.read_store(str(tmp_path / 'store'))
+    assert list(back.index) == list(df.index)
+    assert list(back['overlap_frac'])[1:] == list(df['overlap_frac'])[1:]
+    assert list(back['centroid']) == list(df['centroid'])
+    assert pd.isnull(fstore.read_store(str(tmp_path / 'store'), columns=['overlap_frac'], years=[2016])['overlap_frac']).all()
+
+def test_verify_hashes_each_file_once(tmp_path, monkeypatch):
+    storePath = str(tmp_path / 'store')
+    fstore.write_store(overlap_frame(), storePath)
+    hashed = []
+    file_hash = fstore.file_hash
+    monkeypatch.setattr(fstore, 'file_hash', lambda relFilePath: hashed.append(relFilePath) or file_hash(relFilePath))
+    fstore.read_store(storePath, columns=['state'])
+    n_files = len(hashed)
+    fstore.read_store(storePath, columns=['state'])
+    assert len(hashed) == n_files
+
+    #a file changed on disk is checked again
+    relName = os.path.join(storePath, 'year=2018', 'state.npy')
+    codes = np.load(relName)
+    np.save(relName, codes[::-1])
+    stat = os.stat(relName)
+    os.utime(relName, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    with pytest.raises(ValueError):
+        fstore.read_store(storePath, columns=['state'])
+
+def test_source_hash_follows_the_store(tmp_path):
+    relFilePath = str(tmp_path / 'data.p')
+    df = overlap_frame()[['year', 'state']]
+    df.to_pickle(relFilePath)
+    assert fstore.source_hash(relFilePath) == fstore.file_hash(relFilePath)
+
+    fstore.convert_pickle(relFilePath)
+    assert fstore.source_hash(relFilePath) == fstore.file_hash(os.path.join(fstore.store_path(relFilePath), fstore.MANIFEST))
+
+def test_load_frame_reads_the_pickle_when_the_store_is_stale(tmp_path):
+    relFilePath = str(tmp_path / 'data.p')
+    df = overlap_frame()[['year', 'state']]
+    df.to_pickle(relFilePath)
+    fstore.convert_pickle(relFilePath)
+    #the store hands the columns back with the dtypes of the pickle
+    pd.testing.assert_frame_equal(fstore.load_frame(relFilePath), pd.read_pickle(relFilePath))
+
+    #the pickle is rewritten (e.g. by ingestFunctions.ingest_cycle()) without rebuilding the store
+    df.assign(state='WI').to_pickle(relFilePath)
+    with pytest.warns(UserWarning, match='reading the pickle'):
+        assert list(fstore.load_frame(relFilePath)['state']) == ['WI', 'WI', 'WI']
+    with pytest.warns(UserWarning):
+        assert fstore.source_hash(relFilePath) == fstore.file_hash(relFilePath)
@@ -0,0 +1,31 @@
+import os
+import pickle
+import shutil
+import pytest
+from functions import ingestFunctions as ifunc
+from functions import pipelineFunctions as pl
+
+WIKI_PATH = 'Datasets/fec/2018wiki-12072018.csv'
+
+@pytest.mark.filterwarnings('ignore:Unpickling a shapely')
+def test_new_year_needs_overlap_data(tmp_path):
+    resultsPath, indexPath = str(tmp_path / 'house_results.p'), str(tmp_path / 'master_index.p')
+    pl.results_stage(['Datasets/fec/1976-2016-house.csv', WIKI_PATH], [resultsPath, indexPath])
+    base = str(tmp_path / 'data.p')
+    dropped = str(tmp_path / 'data_REDISTRICTDROP.p')
+    shutil.copyfile(ifunc.BASE_DATASET, base)
+    shutil.copyfile(ifunc.BASE_DATASET[:-2] + '_REDISTRICTDROP.p', dropped)
+    overlap = pickle.load(open('Datasets/all_overlap_data.p', 'rb'))
+    overlapPath = str(tmp_path / 'overlap.p')
+    pickle.dump(overlap[overlap['year'] != 2018], open(overlapPath, 'wb'))
+    before = os.stat(dropped).st_mtime_ns
+
+    with pytest.raises(ValueError, match='overlap'):
+        ifunc.ingest_cycle(2018, ifunc.read_wiki_results(WIKI_PATH, 2018), base=base, datasets=[dropped],
+                           overlapPath=overlapPath, resultsPath=resultsPath, indexPath=indexPath)
+    assert os.stat(dropped).st_mtime_ns == before
+
+    pickle.dump(overlap, open(overlapPath, 'wb'))
+    updated = ifunc.ingest_cycle(2018, ifunc.read_wiki_results(WIKI_PATH, 2018), base=base, datasets=[dropped],
+                                 overlapPath=overlapPath, resultsPath=resultsPath, indexPath=indexPath, save=False)
+    assert not updated[dropped].loc[updated[dropped]['year'] == 2018, ifunc.CENTROID_COLS].isnull().all().any()
@@ -0,0 +1,45 @@
+import pickle
+from functions import pipelineFunctions as pl
+
+COLUMNS = ['a', 'b']
+
+def columns_stage(inputs, outputs, columns=COLUMNS, scale=1):
+    return {'columns': len(columns)*scale}
+
+def test_stage_key_follows_defaults(tmp_path):
+    inputPath = tmp_path / 'input.csv'
+    inputPath.write_text('a,b\n1,2\n')
+    stage = pl.Stage('columns', columns_stage, [str(inputPath)], [str(tmp_path / 'output.p')], {}, ())
+    key = pl.stage_key(stage)
+    assert pl.stage_key(stage._replace(params={'scale': 1})) == key
+    assert pl.stage_key(stage._replace(params={'scale': 2})) != key
+
+    #a default edited in place is picked up too
+    COLUMNS.append('c')
+    try:
+        assert pl.stage_key(stage) != key
+    finally:
+        COLUMNS.pop()
+
+def test_ingested_cycle_survives_a_pipeline_run(tmp_path):
+    from functions import ingestFunctions as ifunc
+    resultsPath, indexPath = str(tmp_path / 'house_results.p'), str(tmp_path / 'master_index.p')
+    basePath = str(tmp_path / 'data.p')
+    wikiPath = 'Datasets/fec/2018wiki-12072018.csv'
+    stages = [pl.Stage('results', pl.results_stage, ['Datasets/fec/1976-2016-house.csv', wikiPath],
+                       [resultsPath, indexPath], {}, []),
+              pl.Stage('trimmed_data', pl.trimmed_data_stage, [resultsPath, 'Datasets/national_poll.p'],
+                       [basePath], {}, [])]
+    cacheDir = str(tmp_path / 'cache')
+    pl.run_pipeline(stages, n_jobs=1, cacheDir=cacheDir, verbose=False)
+
+    #a recount of 2018 that flips the first district
+    wiki = ifunc.read_wiki_results(wikiPath, 2018)
+    wiki.loc[wiki.index[0], 'party'] = 'democrat'
+    ifunc.ingest_cycle(2018, wiki, base=basePath, datasets=[], resultsPath=resultsPath, indexPath=indexPath)
+    ingested = ifunc.load_results(resultsPath)[0]
+
+    report = pl.run_pipeline(stages, n_jobs=1, cacheDir=cacheDir, verbose=False)
+    assert report.loc['results', 'status'] == 'kept'
+    assert ifunc.load_results(resultsPath)[0].equals(ingested)
+    assert pickle.load(open(basePath, 'rb')).loc[wiki.index[0], 'dem_win'] == 1
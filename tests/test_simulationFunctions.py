@@ -0,0 +1,31 @@
+import numpy as np
+import pandas as pd
+import pytest
+from functions import houseFunctions as hfunc
+from functions import simulationFunctions as sfunc
+
+class PollModel:
+    '''Democrat win probability rising with the national poll.'''
+    classes_ = np.array([0, 1])
+
+    def predict_proba(self, X):
+        prob = 1/(1 + np.exp(-(X['national_poll'].values + X['margin'].values)/5))
+        return np.column_stack([1 - prob, prob])
+
+def feature_matrix(index):
+    return pd.DataFrame({'national_poll': 0., 'margin': np.linspace(-10, 10, len(index))}, index=index)
+
+STATES = np.array(['AL', 'AL', 'CA', 'CA', 'CA', 'WI'])
+DISTRICTS = np.array([1, 2, 1, 2, 3, 1])
+
+@pytest.mark.parametrize('index', [
+    pd.Index(hfunc.key_to_index(hfunc.encode_key(STATES, DISTRICTS, 2018)).astype(str), dtype='str'),
+    pd.Index(hfunc.encode_key(STATES, DISTRICTS, 2018), name='key'),
+])
+def test_state_shocks_find_states_in_index(index):
+    np.testing.assert_array_equal(sfunc.district_states(index), STATES)
+    sim = sfunc.simulate_seats(PollModel(), feature_matrix(index), n_scenarios=2000, state_sd=0.2, seed=0,
+                               chunk_size=500, n_jobs=1)
+    assert list(sim['state_seats'].index) == ['AL', 'CA', 'WI']
+    assert list(sim['state_seats']['districts']) == [2, 3, 1]
+    assert sim['seat_hist'].sum() == 2000